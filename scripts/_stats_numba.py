@@ -0,0 +1,103 @@
+"""
+Numba kernels for the parcel statistics.
+
+@date: 2023-05-18
+@author: Lukas Valentin Graf, ETH Zurich
+
+Copyright (C) 2023 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from numba import njit
+
+
+@njit(cache=True)
+def entropy_binned(
+        x_flat: np.ndarray,
+        lo: float,
+        hi: float,
+        nbins: int
+) -> float:
+    """
+    Calculate the entropy of the values in an array after
+    binning them into `nbins` bins of equal width between
+    `lo` and `hi`. NaNs are skipped, values outside the
+    range are put into the first or last bin.
+
+    Parameters
+    ----------
+    x_flat : np.ndarray
+        1-d array with values
+    lo : float
+        lower bound of the first bin
+    hi : float
+        upper bound of the last bin
+    nbins : int
+        number of bins
+    return : float
+        entropy value (NaN if there are no valid values)
+    """
+    counts = np.zeros(nbins, dtype=np.int64)
+    scale = nbins / (hi - lo)
+    n = 0
+    for v in x_flat:
+        if np.isnan(v):
+            continue
+        idx = int((v - lo) * scale)
+        if idx < 0:
+            idx = 0
+        elif idx >= nbins:
+            idx = nbins - 1
+        counts[idx] += 1
+        n += 1
+    if n == 0:
+        return np.nan
+    h = 0.
+    for c in counts:
+        if c > 0:
+            p = c / n
+            h -= p * np.log(p)
+    return h
+
+
+@njit(cache=True)
+def cv_welford(x_flat: np.ndarray) -> float:
+    """
+    Calculate the coefficient of variation (population standard
+    deviation divided by the mean) of the values in an array in
+    a single pass using Welford's algorithm. NaNs are skipped.
+
+    Parameters
+    ----------
+    x_flat : np.ndarray
+        1-d array with values
+    return : float
+        coefficient of variation (NaN if there are no valid values)
+    """
+    n = 0
+    mean = 0.
+    m2 = 0.
+    for v in x_flat:
+        if np.isnan(v):
+            continue
+        n += 1
+        delta = v - mean
+        mean += delta / n
+        m2 += delta * (v - mean)
+    if n == 0:
+        return np.nan
+    return np.sqrt(m2 / n) / mean
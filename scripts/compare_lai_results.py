@@ -23,12 +23,43 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import matplotlib.pyplot as plt
+import numpy as np
+import rasterio
 
-from eodal.core.raster import RasterCollection
 from pathlib import Path
+from typing import Optional, Tuple
 
 
-def plot_lai_maps(lai_s2: Path, lai_ps: Path, out_dir: Path) -> None:
+def _read_lai(fpath: Path) -> Tuple[np.ndarray, Tuple[float]]:
+    """
+    Read the LAI band of a LAI map.
+
+    Parameters
+    ----------
+    fpath : Path
+        Path to the LAI map (GeoTiff)
+    return : Tuple[np.ndarray, Tuple[float]]
+        LAI values (no-data set to NaN) and the extent of the
+        map (left, right, bottom, top) for plotting
+    """
+    with rasterio.open(fpath) as src:
+        # the LAI is stored in the band named 'lai' (or the first band)
+        band_idx = 1
+        if 'lai' in src.descriptions:
+            band_idx = src.descriptions.index('lai') + 1
+        lai = src.read(band_idx, out_dtype='float32', masked=True)
+        bounds = src.bounds
+    extent = (bounds.left, bounds.right, bounds.bottom, bounds.top)
+    return lai.filled(np.nan), extent
+
+
+def plot_lai_maps(
+        lai_s2: Path,
+        lai_ps: Path,
+        out_dir: Path,
+        fig: Optional[plt.Figure] = None,
+        ax: Optional[np.ndarray] = None
+) -> None:
     """
     Plot maps of the LAI retrieved from Sentinel-2 and PlanetScope
     side by side.
@@ -41,22 +72,34 @@ def plot_lai_maps(lai_s2: Path, lai_ps: Path, out_dir: Path) -> None:
         Path to the LAI map retrieved from PlanetScope
     out_dir : Path
         Path to the directory for storing the plots
+    fig : Optional[plt.Figure]
+        Figure to reuse for the plot. The figure is cleared but not
+        closed so that it can be used for plotting the next pair of
+        LAI maps. If None (default) a new figure is created and
+        closed after saving.
+    ax : Optional[np.ndarray]
+        The two axes of `fig`. Must be passed together with `fig`.
     """
-    s2 = RasterCollection.from_multi_band_raster(lai_s2)
-    ps = RasterCollection.from_multi_band_raster(lai_ps)
+    s2, extent_s2 = _read_lai(lai_s2)
+    ps, extent_ps = _read_lai(lai_ps)
     scene = lai_s2.stem.split('_')[0]
     spatial_res_s2 = lai_s2.stem.split('_')[2]
 
     # plot the LAI maps
-    fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(10, 5),
-                           sharey=True, sharex=True)
+    close_fig = fig is None
+    if close_fig:
+        fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(10, 5),
+                               sharey=True, sharex=True)
+    else:
+        for _ax in ax:
+            _ax.cla()
     band_name = 'lai'
     ps_bands = lai_ps.stem.split('_')[-1]
 
-    s2[band_name].plot(ax=ax[0], vmin=0, vmax=8,
-                       colormap='viridis')
-    ps[band_name].plot(ax=ax[1], vmin=0, vmax=8,
-                       colormap='viridis')
+    ax[0].imshow(s2, cmap='viridis', vmin=0, vmax=8, extent=extent_s2,
+                 interpolation='nearest')
+    ax[1].imshow(ps, cmap='viridis', vmin=0, vmax=8, extent=extent_ps,
+                 interpolation='nearest')
     ax[0].set_title(f'Sentinel-2 {band_name.upper()}' +
                     f' ({spatial_res_s2})')
     ax[1].set_title(f'PlanetScope {band_name.upper()} ({ps_bands})')
@@ -64,8 +107,9 @@ def plot_lai_maps(lai_s2: Path, lai_ps: Path, out_dir: Path) -> None:
     # save the plot
     fname_plot = out_dir / \
         f'{scene}_lai_s2-{spatial_res_s2}_ps_{ps_bands}.png'
-    fig.savefig(fname_plot, dpi=300, bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(fname_plot, dpi=100, bbox_inches='tight')
+    if close_fig:
+        plt.close(fig)
 
 
 if __name__ == '__main__':
@@ -78,6 +122,10 @@ if __name__ == '__main__':
     out_dir = Path('analysis/compare_lai_results')  # ignored by git
     out_dir.mkdir(exist_ok=True, parents=True)
 
+    # a single figure is reused for all plots
+    fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(10, 5),
+                           sharey=True, sharex=True)
+
     # set the paths to the LAI maps according to the user inputs
     # LUT maps
     for month in months:
@@ -97,4 +145,7 @@ if __name__ == '__main__':
                     plot_lai_maps(
                         lai_s2=lai_s2,
                         lai_ps=lai_ps,
-                        out_dir=out_dir_month)
+                        out_dir=out_dir_month,
+                        fig=fig,
+                        ax=ax)
+    plt.close(fig)
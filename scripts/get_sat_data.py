@@ -0,0 +1,83 @@
+"""
+Download the Sentinel-2 and PlanetScope data used for the LAI
+retrieval from polybox and unpack it into the `data` folder.
+
+@date: 2023-05-13
+@author: Lukas Valentin Graf, ETH Zurich
+
+Copyright (C) 2023 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import zipfile
+
+from eodal.config import get_settings
+from pathlib import Path
+from urllib.request import urlopen
+
+
+# links to the data archives (see README)
+data_urls = {
+    'sentinel': 'https://polybox.ethz.ch/index.php/s/f3A3sP40G3MKvBJ/download',
+    'planetscope': 'https://polybox.ethz.ch/index.php/s/1n5zC3CZGd4ECBQ/download'
+}
+# size of the chunks (bytes) the archives are downloaded in
+chunk_size = 1 << 20
+logger = get_settings().logger
+
+
+def download_data(url: str, data_dir: Path) -> None:
+    """
+    Download a zip archive and unpack it.
+
+    The archive is streamed to a temporary file in chunks
+    so that it is never held in memory as a whole. The
+    temporary file is removed after unpacking.
+
+    Parameters
+    ----------
+    url : str
+        URL of the zip archive
+    data_dir : Path
+        Directory the archive is unpacked to
+    """
+    data_dir.mkdir(exist_ok=True, parents=True)
+    # the temporary file is placed in data_dir to avoid copying
+    # the archive between file systems
+    tmp = tempfile.NamedTemporaryFile(
+        dir=data_dir, suffix='.zip', delete=False)
+    # errors (e.g., HTTP or disk errors) are passed on as they are,
+    # the temporary file is removed in any case
+    try:
+        with tmp, urlopen(url) as response:
+            shutil.copyfileobj(response, tmp, length=chunk_size)
+        with zipfile.ZipFile(tmp.name) as archive:
+            archive.extractall(data_dir)
+    finally:
+        os.unlink(tmp.name)
+    logger.info(f'Downloaded {url} to {data_dir}')
+
+
+if __name__ == '__main__':
+
+    cwd = Path(__file__).parent.absolute()
+    os.chdir(cwd)
+
+    data_dir = Path('../data')
+    for platform, url in data_urls.items():
+        download_data(url=url, data_dir=data_dir / platform)
@@ -21,16 +21,42 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import matplotlib.pyplot as plt
-import pandas as pd
+import os
 
+# cache the compiled Numba kernels in a fixed directory so that they
+# are compiled only once and reused by all workers and later runs.
+# Numba reads its configuration when it is imported, thus this must
+# be set before any import of Numba (also through other modules)
+os.environ.setdefault(
+    'NUMBA_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.numba_cache'))
+
+import matplotlib
+import multiprocessing
+import numpy as np
+import rasterio
+
+from concurrent.futures import ProcessPoolExecutor
 from eodal.config import get_settings
-from eodal.core.band import Band
-from eodal.core.raster import RasterCollection
+from itertools import repeat
 from pathlib import Path
-from typing import Optional
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from typing import Dict, List, Optional, Tuple
 
-from rtm_inv.core.inversion import inv_img, retrieve_traits
+from rtm_inv.core.inversion import (
+    inv_img_compact,
+    inversion_methods,
+    median_of_solutions,
+    PreparedLUT
+)
+from rtm_inv.core.utils import (
+    default_max_workers,
+    init_worker,
+    load_lut,
+    month_folder_pattern
+)
 
 
 # Bands to use for the LAI retrieval
@@ -50,17 +76,252 @@ ps_4bands = {
     'B4': 'green',
     'B6': 'red',
     'B8': 'nir'}
+# number of best solutions to use for the LAI retrieval
+n_solutions = 5000
+# size of the blocks (pixels) the scenes are processed in. The
+# inversion of a block takes up about n_solutions * block_size**2 * 16
+# bytes (LUT indices and their intermediate copies and the cost
+# function values of the best solutions), i.e., 1.3 GB for 128 pixels
+block_size = 128
+worker_memory = n_solutions * block_size**2 * 16
+# tile size and overview levels of the LAI GeoTiff
+tile_size = 512
+overview_factors = [2, 4, 8]
+# names of the bands in the LAI GeoTiff
+output_band_names = [
+    'lai', 'lowest_cost_function_value', 'highest_cost_function_value']
 logger = get_settings().logger
 
 
+def _compile_kernels(n_bands: int, inversion_method: str) -> None:
+    """
+    Compile the Numba kernels of the inversion method (or load them
+    from the cache) by inverting a dummy image.
+
+    This is done once in the main process before the workers are
+    started. The compiled kernels are written to the Numba cache,
+    from which the workers load them. Otherwise, each worker would
+    compile the kernels itself the first time it is used.
+
+    The workers must be started with the 'spawn' method afterwards.
+    Forked workers would inherit the thread pool of the parallel
+    kernels, which Numba does not allow for the OpenMP threading
+    layer.
+
+    Parameters
+    ----------
+    n_bands : int
+        Number of spectral bands used for the inversion
+    inversion_method : str
+        One of `rtm_inv.core.inversion.inversion_methods`
+    """
+    inv_img_compact(
+        lut=np.zeros((2, n_bands), dtype='float32'),
+        img=np.zeros((n_bands, 1, 1), dtype='float32'),
+        mask=np.zeros((1, 1), dtype='bool'),
+        n_solutions=1,
+        method=inversion_method)
+
+
+def _band_indices(
+        src: rasterio.DatasetReader,
+        band_names: List[str]
+) -> List[int]:
+    """
+    Get the indices of PlanetScope bands in a scene. The band names
+    are stored as band descriptions. Scenes without band descriptions
+    must have all eight bands in the order of `ps_8bands`.
+
+    Parameters
+    ----------
+    src : rasterio.DatasetReader
+        Opened PlanetScope scene
+    band_names : List[str]
+        Names of the bands (e.g., 'blue')
+    return : List[int]
+        Band indices (starting at 1)
+    """
+    if all(description is None for description in src.descriptions):
+        if src.count != len(ps_8bands):
+            raise ValueError(
+                f'{src.name} has no band descriptions and '
+                f'{src.count} instead of {len(ps_8bands)} bands')
+        descriptions = list(ps_8bands.values())
+    else:
+        descriptions = list(src.descriptions)
+    missing = [name for name in band_names if name not in descriptions]
+    if missing:
+        raise ValueError(f'{src.name} has no band(s) {missing}')
+    return [descriptions.index(name) + 1 for name in band_names]
+
+
+def _retrieve_scene(
+        scene: Path,
+        lai_dir: Path,
+        prepared_lut: PreparedLUT,
+        lai: np.ndarray,
+        ps_bands: Dict[str, str],
+        lai_file_prefix: str
+) -> None:
+    """
+    Run the LAI retrieval for a single PlanetScope scene.
+
+    Parameters
+    ----------
+    scene : Path
+        Path to the PlanetScope scene (GeoTiff)
+    lai_dir : Path
+        Directory for storing the LAI results
+    prepared_lut : PreparedLUT
+        Lookup-table prepared for the inversion
+    lai : np.ndarray
+        LAI values of the lookup-table
+    ps_bands : Dict[str, str]
+        PlanetScope bands to use (LUT column names mapped
+        to the band names in the scene)
+    lai_file_prefix : str
+        Suffix appended to the scene name for the LAI files
+    """
+    folder = lai_dir.parent
+    fpath_lai = lai_dir / \
+        (scene.stem + f'_{lai_file_prefix}.tif')
+    with rasterio.open(scene) as src:
+        # band indices of the selected bands
+        band_idxs = _band_indices(src, list(ps_bands.values()))
+        profile = src.profile.copy()
+        profile.update(
+            driver='GTiff',
+            count=3,
+            dtype='float32',
+            nodata=np.nan,
+            tiled=True,
+            blockxsize=tile_size,
+            blockysize=tile_size,
+            compress='lzw',
+            predictor=3,
+            BIGTIFF='IF_SAFER')
+        # LAI values for the Quicklook
+        lai_img = np.full((src.height, src.width), np.nan, dtype='float32')
+
+        with rasterio.open(fpath_lai, 'w', **profile) as dst:
+            for band_idx, band_name in enumerate(output_band_names):
+                dst.set_band_description(band_idx + 1, band_name)
+            # process the scene block by block
+            for row_off in range(0, src.height, block_size):
+                for col_off in range(0, src.width, block_size):
+                    window = Window(
+                        col_off,
+                        row_off,
+                        min(block_size, src.width - col_off),
+                        min(block_size, src.height - row_off))
+                    # read the observed reflectance data
+                    obs_refl = src.read(
+                        band_idxs, window=window, out_dtype='float32')
+                    # convert to reflectance [0, 1] (stays float32)
+                    obs_refl *= np.float32(0.0001)
+                    # the actual inversion
+                    mask = obs_refl[0, :, :] == 0.
+                    # (only the lowest and highest cost function value
+                    # are kept)
+                    lut_idxs, cost_function_values = inv_img_compact(
+                        lut=prepared_lut,
+                        img=obs_refl,
+                        mask=mask,
+                        n_solutions=n_solutions,
+                        extreme_costs_only=True
+                    )
+                    # LAI is the median of the LAI values of the best
+                    # solutions (NaN for masked pixels)
+                    lai_block = median_of_solutions(lai, lut_idxs)
+                    del lut_idxs
+                    # save LAI, lowest and highest cost function value
+                    dst.write(
+                        np.concatenate([
+                            lai_block[np.newaxis],
+                            cost_function_values
+                        ]),
+                        window=window)
+                    lai_img[
+                        row_off:row_off + window.height,
+                        col_off:col_off + window.width] = lai_block
+            # internal overviews for fast reads at reduced resolution
+            dst.build_overviews(overview_factors, Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+    # save a Quicklook png (one pixel per LAI value, LAI from 0 to 8,
+    # no-data is transparent)
+    rgba = matplotlib.colormaps['viridis'](
+        np.clip(lai_img / 8., 0., 1.), bytes=True)
+    fpath_lai_plot = lai_dir / \
+        (scene.stem + f'_{lai_file_prefix}.png')
+    Image.fromarray(rgba).save(fpath_lai_plot, optimize=True)
+
+    logger.info(
+        f'Finished LAI retrieval for {folder.name}: {scene.name}')
+
+
+def _retrieve_group(
+        lut_file: Path,
+        scenes: List[Path],
+        lai_dirs: List[Path],
+        ps_bands: Dict[str, str],
+        lai_file_prefix: str,
+        inversion_method: str
+) -> None:
+    """
+    Run the LAI retrieval for all PlanetScope scenes sharing
+    the same lookup-table.
+
+    The lookup-table is read and prepared for the inversion
+    (e.g., sorted or indexed by a k-d tree) only once for all
+    scenes.
+
+    Parameters
+    ----------
+    lut_file : Path
+        Path to the lookup-table shared by the scenes
+    scenes : List[Path]
+        Paths to the PlanetScope scenes (GeoTiff)
+    lai_dirs : List[Path]
+        Directories for storing the LAI results of the scenes
+    ps_bands : Dict[str, str]
+        PlanetScope bands to use (LUT column names mapped
+        to the band names in the scene)
+    lai_file_prefix : str
+        Suffix appended to the scene name for the LAI files
+    inversion_method : str
+        One of `rtm_inv.core.inversion.inversion_methods`
+    """
+    # get the simulated reflectance data and LAI values
+    sim_refl, lai = load_lut(lut_file, list(ps_bands.keys()))
+    # a single thread for querying the k-d tree (see `init_worker`)
+    prepared_lut = PreparedLUT(sim_refl, method=inversion_method, workers=1)
+    for scene, lai_dir in zip(scenes, lai_dirs):
+        # a scene with unexpected bands must not stop the other scenes
+        try:
+            _retrieve_scene(
+                scene, lai_dir, prepared_lut, lai, ps_bands, lai_file_prefix)
+        except ValueError as e:
+            logger.error(f'LAI retrieval failed for {scene.name}: {e}')
+            errored_scenes_dir = lai_dir / 'errored_scenes'
+            errored_scenes_dir.mkdir(exist_ok=True)
+            with open(
+                errored_scenes_dir /
+                    'errored_scenes.txt', 'a') as f:
+                f.write(f'{scene.name}\n')
+
+
 def lai_retrieval_planetscope(
         path: Path,
-        four_or_eight_bands: Optional[str] = 'four') -> None:
+        four_or_eight_bands: Optional[str] = 'four',
+        inversion_method: Optional[str] = 'numba',
+        max_workers: Optional[int] = None) -> None:
     """
     Run the LAI retrieval for PlanetScope data.
 
     Retrieval is either done for all 8 bands and for those
     4 bands that are compatible with Sentinel-2 10 m bands.
+    The scenes are processed in parallel.
 
     Parameters
     ----------
@@ -71,12 +332,26 @@ def lai_retrieval_planetscope(
         Either 'four' or 'eight' to indicate whether
         the retrieval should be done for 4 or 8 bands.
         Default is 'four'.
+    inversion_method : Optional[str]
+        Either 'numba' to use the Numba kernel, 'gemm' to use
+        the blocked matrix multiplication (BLAS), 'int16' to use
+        the Numba kernel on int16-quantized reflectance or 'kdtree'
+        to query a k-d tree for finding the best solutions in the
+        lookup-table. Default is 'numba'.
+    max_workers : Optional[int]
+        Number of worker processes. Defaults to the number
+        of CPUs but not more than fit into the available
+        memory (see `worker_memory`).
     """
     # check the input
     if four_or_eight_bands not in ['four', 'eight']:
         raise ValueError(
             f'four_or_eight_bands must be either "four" or "eight", '
             f'but is {four_or_eight_bands}')
+    if inversion_method not in inversion_methods:
+        raise ValueError(
+            f'inversion_method must be one of {inversion_methods}, '
+            f'but is {inversion_method}')
 
     # determine the lai settings
     if four_or_eight_bands == 'four':
@@ -86,117 +361,73 @@ def lai_retrieval_planetscope(
         ps_bands = ps_8bands
         lai_file_prefix = 'lai_8bands'
 
+    # scenes to process grouped by their (resolved) LUT file. Scenes
+    # with the same acquisition geometry share the same LUT
+    groups: Dict[Path, Tuple[List[Path], List[Path]]] = {}
     # loop over the folders. Jump into a folder if it starts
     # with two digits followed by an underscore and three letters
-    for folder in path.iterdir():
-        if folder.name[:2].isdigit() and folder.name[2] == '_':
-            # loop over the scenes
-            data_dir = folder / 'data'
-            # directory with LUTs
-            lut_dir = folder / 'lut'
-            # directory for storing LAI results
-            lai_dir = folder / 'lai'
-            lai_dir.mkdir(exist_ok=True)
-
-            # loop over the scenes
-            for scene in data_dir.glob('*.tif'):
-
-                # skip if the scene is already processed
-                fpath_lai = lai_dir / \
-                    (scene.stem + f'_{lai_file_prefix}.tif')
-                if fpath_lai.exists():
-                    logger.info(f'Skipping {scene.name}')
-                    continue
-
-                # find the corresponding LUT
-                lut_file = lut_dir / (scene.stem + '.pkl')
-                # raise a warning if the LUT is not found
-                if not lut_file.exists():
-                    logger.warning(
-                        f'No LUT found for {folder.name}: {scene.name}')
-                    errored_scenes_dir = lai_dir / 'errored_scenes'
-                    errored_scenes_dir.mkdir(exist_ok=True)
-                    with open(
-                        errored_scenes_dir /
-                            'errored_scenes.txt', 'a') as f:
-                        f.write(f'{scene.name}\n')
-                    continue
-
-                lut = pd.read_pickle(lut_file)
-                # get the simulated reflectance data
-                sim_refl = lut[list(ps_bands.keys())].values
-                # read the observed reflectance data
-                rc = RasterCollection.from_multi_band_raster(scene)
-                obs_refl = rc.get_values(
-                    band_selection=list(ps_bands.values())).astype(float)
-                obs_refl *= 0.0001  # convert to reflectance [0, 1]
-                # the actual inversion
-                mask = obs_refl[0, :, :] == 0.
-                lut_idxs, cost_function_values = inv_img(
-                    lut=sim_refl,
-                    img=obs_refl,
-                    cost_function='rmse',
-                    n_solutions=5000,
-                    mask=mask
-                )
-                trait_img, _, _ = retrieve_traits(
-                    lut=lut,
-                    lut_idxs=lut_idxs,
-                    traits=['lai'],
-                    cost_function_values=cost_function_values,
-                    measure='median'
-                )
-
-                # save lowest, median and highest cost function value
-                highest_cost_function_vals = cost_function_values[-1, :, :]
-                lowest_cost_function_vals = cost_function_values[0, :, :]
-
-                # save the results
-                trait_collection = RasterCollection()
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='lai',
-                    values=trait_img[0, :, :]
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='lowest_cost_function_value',
-                    values=lowest_cost_function_vals
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='highest_cost_function_value',
-                    values=highest_cost_function_vals
-                )
-                # save as GeoTiff
-                trait_collection.to_rasterio(fpath_lai)
-
-                # save a Quicklook png
-                f, ax = plt.subplots(1, 1, figsize=(10, 10))
-                trait_collection['lai'].plot(
-                    colormap='viridis',
-                    colorbar_label=r'LAI [m$^2$ m$^{-2}$]',
-                    vmin=0.,
-                    vmax=8.,
-                    ax=ax,
-                    fontsize=18
-                )
-                ax.set_title('')
-                fpath_lai_plot = lai_dir / \
-                    (scene.stem + f'_{lai_file_prefix}.png')
-                f.savefig(fpath_lai_plot, dpi=300)
-                plt.close(f)
-
-                logger.info(
-                    f'Finished LAI retrieval for {folder.name}: {scene.name}')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and month_folder_pattern.match(entry.name):
+                folder = Path(entry.path)
+                # loop over the scenes
+                data_dir = folder / 'data'
+                # directory with LUTs
+                lut_dir = folder / 'lut'
+                # directory for storing LAI results
+                lai_dir = folder / 'lai'
+                lai_dir.mkdir(exist_ok=True)
+
+                for scene in data_dir.glob('*.tif'):
+                    # skip if the scene is already processed
+                    fpath_lai = lai_dir / \
+                        (scene.stem + f'_{lai_file_prefix}.tif')
+                    if fpath_lai.exists():
+                        logger.info(f'Skipping {scene.name}')
+                        continue
+
+                    # find the corresponding LUT (LUTs from older runs
+                    # are pickled)
+                    lut_file = lut_dir / (scene.stem + '.parquet')
+                    if not lut_file.exists():
+                        lut_file = lut_file.with_suffix('.pkl')
+                    # raise a warning if the LUT is not found
+                    if not lut_file.exists():
+                        logger.warning(
+                            f'No LUT found for {folder.name}: {scene.name}')
+                        errored_scenes_dir = lai_dir / 'errored_scenes'
+                        errored_scenes_dir.mkdir(exist_ok=True)
+                        with open(
+                            errored_scenes_dir /
+                                'errored_scenes.txt', 'a') as f:
+                            f.write(f'{scene.name}\n')
+                        continue
+
+                    group_scenes, group_lai_dirs = groups.setdefault(
+                        lut_file.resolve(), ([], []))
+                    group_scenes.append(scene)
+                    group_lai_dirs.append(lai_dir)
+
+    # process the groups of scenes in parallel. The workers are
+    # spawned as the kernels were run in this process already
+    _compile_kernels(len(ps_bands), inversion_method)
+    lut_files = list(groups.keys())
+    with ProcessPoolExecutor(
+            max_workers=max_workers or default_max_workers(worker_memory),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker) as executor:
+        list(executor.map(
+            _retrieve_group,
+            lut_files,
+            [groups[lut_file][0] for lut_file in lut_files],
+            [groups[lut_file][1] for lut_file in lut_files],
+            repeat(ps_bands),
+            repeat(lai_file_prefix),
+            repeat(inversion_method)))
 
 
 if __name__ == '__main__':
 
-    import os
     cwd = Path(__file__).parent.absolute()
     os.chdir(cwd)
 
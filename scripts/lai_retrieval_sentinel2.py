@@ -25,144 +25,225 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
+import os
+import rasterio
 
+from concurrent.futures import ProcessPoolExecutor
 from eodal.config import get_settings
-from eodal.core.band import Band
 from eodal.core.raster import RasterCollection
+from itertools import repeat
 from pathlib import Path
-
-from rtm_inv.core.inversion import inv_img, retrieve_traits
+from typing import Dict, Optional, Tuple
+
+from rtm_inv.core.inversion import (
+    inv_img_compact,
+    median_of_solutions,
+    PreparedLUT
+)
+from rtm_inv.core.utils import (
+    default_max_workers,
+    init_worker,
+    load_lut,
+    month_folder_pattern
+)
 
 # Bands to use for the LAI retrieval
 s2_bands_10m = ['B02', 'B03', 'B04', 'B08']
 s2_bands_20m = ['B05', 'B06', 'B07', 'B8A', 'B11', 'B12']
 s2_bands = {'10m': s2_bands_10m, '20m': s2_bands_20m}
+# number of best solutions to use for the LAI retrieval
+n_solutions = 5000
+# size of the blocks (pixels) the scenes are inverted in. The
+# inversion of a block takes up about n_solutions * block_size**2 * 16
+# bytes (LUT indices and their intermediate copies and the cost
+# function values of the best solutions), i.e., 1.3 GB for 128 pixels
+block_size = 128
+worker_memory = n_solutions * block_size**2 * 16
+# tile size of the LAI GeoTiff and names of its bands
+tile_size = 512
+output_band_names = [
+    'lai', 'lowest_cost_function_value', 'highest_cost_function_value']
 
 logger = get_settings().logger
+# LUTs loaded by the current (worker) process
+_luts: Dict[Tuple[Path, str], Tuple[PreparedLUT, np.ndarray]] = {}
+
 
+def _retrieve_scene(
+        scene: Path,
+        lut_dir: Path,
+        lai_dir: Path,
+        make_quicklook: bool
+) -> None:
+    """
+    Run the LAI retrieval for a single Sentinel-2 scene.
 
-def lai_retrieval_sentinel2(path: Path) -> None:
+    Parameters
+    ----------
+    scene : Path
+        Path to the Sentinel-2 scene (GeoTiff)
+    lut_dir : Path
+        Directory with the lookup-tables
+    lai_dir : Path
+        Directory for storing the LAI results
+    make_quicklook : bool
+        Whether to save a Quicklook png of the LAI
+    """
+    folder = lai_dir.parent
+    # check the spatial resolution of the scene
+    spatial_res_scene = scene.stem.split('_')[-1]
+    if spatial_res_scene not in s2_bands.keys():
+        return
+
+    # skip if the scene is already processed
+    fpath_lai = lai_dir / (scene.stem + '_lai.tif')
+    if fpath_lai.exists():
+        logger.info(f'Skipping {scene.name}')
+        return
+
+    # find the corresponding LUT (LUTs from older runs
+    # are pickled)
+    lut_file = lut_dir / \
+        (scene.stem.split('_')[0] + '_MTD_TL.parquet')
+    if not lut_file.exists():
+        lut_file = lut_file.with_suffix('.pkl')
+    # raise a warning if the LUT is not found
+    if not lut_file.exists():
+        logger.warning(
+            f'No LUT found for {folder.name}: {scene.name}')
+        errored_scenes_dir = lai_dir / 'errored_scenes'
+        errored_scenes_dir.mkdir(exist_ok=True)
+        with open(
+            errored_scenes_dir /
+                'errored_scenes.txt', 'a') as f:
+            f.write(f'{scene.name}\n')
+        return
+
+    # get the simulated reflectance data and LAI values (LUTs
+    # already loaded and prepared by the worker are reused)
+    lut_key = (lut_file, spatial_res_scene)
+    if lut_key not in _luts:
+        sim_refl, lai = load_lut(lut_file, s2_bands[spatial_res_scene])
+        _luts[lut_key] = (PreparedLUT(sim_refl), lai)
+    prepared_lut, lai = _luts[lut_key]
+
+    # get the reflectance dataset
+    rc = RasterCollection.from_multi_band_raster(scene)
+    obs_refl = np.ascontiguousarray(rc.get_values(), dtype=np.float32)
+
+    # the actual inversion block by block so that the memory taken
+    # up by the best solutions does not scale with the scene size
+    # (pixels without data in any band are skipped)
+    mask = ~np.any(obs_refl, axis=0)
+    # LAI, lowest and highest cost function value
+    results = np.empty(
+        (len(output_band_names),) + mask.shape, dtype='float32')
+    for row_off in range(0, mask.shape[0], block_size):
+        for col_off in range(0, mask.shape[1], block_size):
+            rows = slice(row_off, row_off + block_size)
+            cols = slice(col_off, col_off + block_size)
+            lut_idxs, cost_function_values = inv_img_compact(
+                lut=prepared_lut,
+                img=obs_refl[:, rows, cols],
+                mask=mask[rows, cols],
+                n_solutions=n_solutions,
+                extreme_costs_only=True
+            )
+            # LAI is the median of the LAI values of the best
+            # solutions (NaN for masked pixels)
+            results[0, rows, cols] = median_of_solutions(lai, lut_idxs)
+            results[1:, rows, cols] = cost_function_values
+
+    # save the results as tiled, compressed GeoTiff in the geometry
+    # of the scene
+    with rasterio.open(scene) as src:
+        profile = src.profile.copy()
+    profile.update(
+        driver='GTiff',
+        count=len(output_band_names),
+        dtype='float32',
+        nodata=np.nan,
+        tiled=True,
+        blockxsize=tile_size,
+        blockysize=tile_size,
+        compress='zstd',
+        predictor=3,
+        BIGTIFF='IF_SAFER')
+    with rasterio.open(fpath_lai, 'w', **profile) as dst:
+        for band_idx, band_name in enumerate(output_band_names):
+            dst.set_band_description(band_idx + 1, band_name)
+        dst.write(results)
+
+    # save a Quicklook png (one pixel per LAI value, LAI from 0 to 8)
+    if make_quicklook:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        fpath_lai_plot = lai_dir / (scene.stem + '_lai.png')
+        plt.imsave(
+            fpath_lai_plot, results[0, :, :], cmap='viridis', vmin=0.,
+            vmax=8.)
+
+    logger.info(
+        f'Finished LAI retrieval for {folder.name}: {scene.name}')
+
+
+def lai_retrieval_sentinel2(
+        path: Path,
+        max_workers: Optional[int] = None,
+        make_quicklook: Optional[bool] = False
+) -> None:
     """
     Run the LAI retrieval for Sentinel2 data.
     The script produces LAI maps from the 10 and 20 m
-    bands.
+    bands. The scenes are processed in parallel.
 
     Parameters
     ----------
     path : Path
         Path to the Sentinel-2 reflectance data
         and lookup-tables with PROSAIL simulations
+    max_workers : Optional[int]
+        Number of worker processes. Defaults to the number
+        of CPUs but not more than fit into the available
+        memory (see `worker_memory`). Each worker is
+        single-threaded.
+    make_quicklook : Optional[bool]
+        Whether to save a Quicklook png of the LAI per scene.
+        Default is False.
     """
+    scenes, lut_dirs, lai_dirs = [], [], []
     # loop over the folders. Jump into a folder if it starts
     # with two digits followed by an underscore and three letters
-    for folder in path.iterdir():
-        if folder.name[:2].isdigit() and folder.name[2] == '_':
-            # loop over the scenes
-            data_dir = folder / 'data'
-            # directory with LUTs
-            lut_dir = folder / 'lut'
-            # directory for storing LAI results
-            lai_dir = folder / 'lai'
-            lai_dir.mkdir(exist_ok=True)
-
-            # loop over the scenes
-            for scene in data_dir.glob('*.tif'):
-
-                # check the spatial resolution of the scene
-                spatial_res_scene = scene.stem.split('_')[-1]
-                if spatial_res_scene not in s2_bands.keys():
-                    continue
-
-                # skip if the scene is already processed
-                fpath_lai = lai_dir / (scene.stem + '_lai.tif')
-                if fpath_lai.exists():
-                    logger.info(f'Skipping {scene.name}')
-                    continue
-
-                # find the corresponding LUT
-                lut_file = lut_dir / (scene.stem.split('_')[0] + '_MTD_TL.pkl')
-                # raise a warning if the LUT is not found
-                if not lut_file.exists():
-                    logger.warning(
-                        f'No LUT found for {folder.name}: {scene.name}')
-                    errored_scenes_dir = lai_dir / 'errored_scenes'
-                    errored_scenes_dir.mkdir(exist_ok=True)
-                    with open(
-                        errored_scenes_dir /
-                            'errored_scenes.txt', 'a') as f:
-                        f.write(f'{scene.name}\n')
-                    continue
-
-                lut = pd.read_pickle(lut_file)
-                sim_refl = lut[s2_bands[spatial_res_scene]].values
-
-                # get the reflectance dataset
-                rc = RasterCollection.from_multi_band_raster(scene)
-                obs_refl = rc.get_values()
-
-                # the actual inversion
-                mask = obs_refl[0, :, :] == 0.
-                lut_idxs, cost_function_values = inv_img(
-                    lut=sim_refl,
-                    img=obs_refl,
-                    cost_function='rmse',
-                    n_solutions=5000,
-                    mask=mask
-                )
-                trait_img, _, _ = retrieve_traits(
-                    lut=lut,
-                    lut_idxs=lut_idxs,
-                    traits=['lai'],
-                    cost_function_values=cost_function_values,
-                    measure='median'
-                )
-
-                # save lowest, median and highest cost function value
-                highest_cost_function_vals = cost_function_values[-1, :, :]
-                lowest_cost_function_vals = cost_function_values[0, :, :]
-
-                # save the results
-                trait_collection = RasterCollection()
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='lai',
-                    values=trait_img[0, :, :]
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='lowest_cost_function_value',
-                    values=lowest_cost_function_vals
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=rc[rc.band_names[0]].geo_info,
-                    band_name='highest_cost_function_value',
-                    values=highest_cost_function_vals
-                )
-                # save as GeoTiff
-                trait_collection.to_rasterio(fpath_lai)
-
-                # save a Quicklook png
-                f, ax = plt.subplots(1, 1, figsize=(10, 10))
-                trait_collection['lai'].plot(
-                    colormap='viridis',
-                    colorbar_label=r'LAI [m$^2$ m$^{-2}$]',
-                    vmin=0.,
-                    vmax=8.,
-                    ax=ax,
-                    fontsize=18
-                )
-                ax.set_title('')
-                fpath_lai_plot = lai_dir / (scene.stem + '_lai.png')
-                f.savefig(fpath_lai_plot, dpi=300)
-                plt.close(f)
-
-                logger.info(
-                    f'Finished LAI retrieval for {folder.name}: {scene.name}')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and month_folder_pattern.match(entry.name):
+                folder = Path(entry.path)
+                # loop over the scenes
+                data_dir = folder / 'data'
+                # directory with LUTs
+                lut_dir = folder / 'lut'
+                # directory for storing LAI results
+                lai_dir = folder / 'lai'
+                lai_dir.mkdir(exist_ok=True)
+
+                # collect the scenes
+                for scene in data_dir.glob('*.tif'):
+                    scenes.append(scene)
+                    lut_dirs.append(lut_dir)
+                    lai_dirs.append(lai_dir)
+
+    # process the scenes in parallel
+    with ProcessPoolExecutor(
+            max_workers=max_workers or default_max_workers(worker_memory),
+            initializer=init_worker) as executor:
+        list(executor.map(
+            _retrieve_scene,
+            scenes,
+            lut_dirs,
+            lai_dirs,
+            repeat(make_quicklook)))
 
 
 if __name__ == '__main__':
@@ -22,37 +22,58 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
+import os
 import pandas as pd
-import seaborn as sns
+import rasterio
 import warnings
 
-from eodal.core.raster import RasterCollection
-from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from pyogrio import read_dataframe
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from typing import Dict, List, Optional, Tuple
 
-warnings.filterwarnings('ignore')
-common_crs = 'EPSG:2056'
+from rtm_inv.core.utils import month_folder_pattern
 
+try:
+    from _stats_numba import cv_welford, entropy_binned
+except ImportError:
+    # Numba is not installed, use the NumPy implementations below
+    cv_welford = entropy_binned = None
 
-def masked_array_to_ndarray(func):
+warnings.filterwarnings('ignore')
+common_crs = 'EPSG:2056'
+# range of the LAI values and number of bins for the entropy
+entropy_range = (0., 10.)
+entropy_bins = 1024
+# statistical measures computed per parcel
+stats_methods = [
+    'median', 'count', 'mean', 'min', 'max', 'percentile_10',
+    'percentile_90', 'std', 'entropy', 'coefficient_of_variation']
+# columns of the parcel statistics used for comparing the retrievals
+compare_columns = ['config', 'month', 'coefficient_of_variation', 'entropy']
+
+
+def _materialize(x: np.ndarray) -> np.ndarray:
     """
-    Decorator to convert a masked array to a numpy array
-    and checks for nan values.
+    Return the values of a raster array as flat numpy array with
+    masked values set to NaN. Arrays that are not masked are not
+    copied. All-NaN arrays need no special treatment as the
+    kernels return NaN if there are no valid values.
+
+    :param x:
+        array with raster values (masked or not)
+    :returns:
+        1-d array with raster values
     """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        x = args[0]
-        if isinstance(x, np.ma.MaskedArray):
-            x = x.filled(np.nan)
-            if np.isnan(x).all():
-                return np.nan
-        return func(x, **kwargs)
-    return wrapper
-
-
-@masked_array_to_ndarray
+    if isinstance(x, np.ma.MaskedArray):
+        x = x.filled(np.nan)
+    return np.ravel(x)
+
+
 def coefficient_of_variation(x: np.ma.MaskedArray) -> float:
     """
     Calculate the coefficient of variation for a raster array.
@@ -62,30 +83,287 @@ def coefficient_of_variation(x: np.ma.MaskedArray) -> float:
     :returns:
         median absolute deviation value
     """
-    return np.nanstd(x, axis=None) / np.nanmean(x)
+    x = _materialize(x)
+    if cv_welford is None:
+        return np.nanstd(x) / np.nanmean(x)
+    return cv_welford(x)
+
+
+def _entropy_bincount(
+        x_flat: np.ndarray,
+        lo: float,
+        hi: float,
+        nbins: int
+) -> float:
+    """
+    NumPy implementation of `_stats_numba.entropy_binned` used
+    if Numba is not available.
+
+    :param x_flat:
+        1-d array with values
+    :param lo:
+        lower bound of the first bin
+    :param hi:
+        upper bound of the last bin
+    :param nbins:
+        number of bins
+    :returns:
+        entropy value
+    """
+    v = x_flat[~np.isnan(x_flat)]
+    if v.size == 0:
+        return np.nan
+    idx = np.clip(
+        ((v - lo) * (nbins / (hi - lo))).astype(np.int64), 0, nbins - 1)
+    c = np.bincount(idx, minlength=nbins)
+    p = c[c > 0] / v.size
+    return -np.sum(p * np.log(p))
 
 
-@masked_array_to_ndarray
 def entropy(x: np.ma.MaskedArray) -> float:
     """
-    Calculate the entropy for a raster array.
+    Calculate the entropy for a raster array. The values are
+    binned into `entropy_bins` bins between `entropy_range`.
 
     :param x:
         array with raster values
     :returns:
         entropy value
     """
-    p = np.unique(x, return_counts=True)[1] / x.size
-    return -np.sum(p * np.log(p))
+    func = _entropy_bincount if entropy_binned is None else entropy_binned
+    return func(
+        _materialize(x), entropy_range[0], entropy_range[1], entropy_bins)
+
+
+@lru_cache(maxsize=32)
+def _load_parcels(
+        path_str: str,
+        mtime: float,
+        crs: Optional[str] = None
+) -> gpd.GeoDataFrame:
+    """
+    Read parcel polygons and re-project them. The results are
+    cached so that scenes sharing the same parcels do not read
+    and re-project them again. Do not modify the returned
+    GeoDataFrame in place.
+
+    Parameters
+    ----------
+    path_str : str
+        Path to the parcel polygons
+    mtime : float
+        Modification time of the file (part of the cache key so
+        that changed files are read again)
+    crs : Optional[str]
+        CRS to re-project the polygons to. If None (default) the
+        polygons are returned in their original CRS.
+    return : gpd.GeoDataFrame
+        Parcel polygons
+    """
+    if crs is None:
+        return gpd.read_file(path_str)
+    return _load_parcels(path_str, mtime).to_crs(crs)
+
+
+@lru_cache(maxsize=8)
+def _parcel_pixel_index(
+        path_str: str,
+        mtime: float,
+        crs: str,
+        transform: Tuple[float],
+        shape: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rasterize parcel polygons onto a raster grid and return the
+    (flat) indices of the pixels of each parcel. The result is
+    cached so that LAI scenes sharing the same grid and parcels
+    (e.g., 4 and 8 bands or 10 and 20 m) rasterize the parcels
+    only once.
+
+    A pixel belongs to a parcel if its center is inside the parcel.
+    Parcels might overlap, and a pixel then belongs to each of them.
+    As rasterizing assigns a pixel to a single value, the parcels are
+    rasterized in layers of parcels that do not intersect each other.
+
+    Parameters
+    ----------
+    path_str : str
+        Path to the parcel polygons
+    mtime : float
+        Modification time of the file
+    crs : str
+        CRS of the raster grid
+    transform : Tuple[float]
+        Affine transformation (a, b, c, d, e, f) of the raster grid
+    shape : Tuple[int, int]
+        Number of rows and columns of the raster grid
+    return : Tuple[np.ndarray, np.ndarray]
+        Pixel indices sorted by parcel and offsets into the pixel
+        indices. The pixels of the i-th parcel are
+        `pixel_idxs[offsets[i]:offsets[i+1]]`.
+    """
+    gdf = _load_parcels(path_str, mtime, crs)
+    geoms = gdf.geometry.values
+    valid = np.flatnonzero(
+        ~(gdf.geometry.isna() | gdf.geometry.is_empty).values)
+
+    # assign the parcels to layers so that parcels intersecting each
+    # other are in different layers (greedy coloring)
+    layers = np.full(gdf.shape[0], -1, dtype='int64')
+    neighbors: Dict[int, List[int]] = {}
+    if valid.size > 0:
+        query_idxs, tree_idxs = gdf.sindex.query(
+            geoms[valid], predicate='intersects')
+        for i, j in zip(valid[query_idxs], tree_idxs):
+            if i != j:
+                neighbors.setdefault(i, []).append(j)
+    for i in valid:
+        used = {layers[j] for j in neighbors.get(i, [])}
+        layer = 0
+        while layer in used:
+            layer += 1
+        layers[i] = layer
+
+    # rasterize the layers; pixels not covered by a parcel are labeled 0
+    labels, pixels = [], []
+    for layer in range(layers.max(initial=-1) + 1):
+        shapes = [
+            (geoms[i], i + 1) for i in np.flatnonzero(layers == layer)]
+        layer_labels = rasterize(
+            shapes, out_shape=shape, transform=Affine(*transform),
+            fill=0, dtype='int32').ravel()
+        layer_pixels = np.flatnonzero(layer_labels)
+        labels.append(layer_labels[layer_pixels])
+        pixels.append(layer_pixels)
+    labels = np.concatenate(labels) if labels else np.zeros(0, 'int32')
+    pixels = np.concatenate(pixels) if pixels else np.zeros(0, 'int64')
+    pixel_idxs = pixels[np.argsort(labels, kind='stable')]
+    offsets = np.cumsum(np.bincount(labels, minlength=gdf.shape[0] + 1))
+    return pixel_idxs, offsets
+
+
+def _parcel_statistics(values: np.ndarray) -> Dict[str, float]:
+    """
+    Calculate the statistical measures for the pixels of a parcel.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        LAI values of the pixels of the parcel (NaN for no-data)
+    return : Dict[str, float]
+        Statistical measures by name (`stats_methods`)
+    """
+    v = values[~np.isnan(values)]
+    if v.size == 0:
+        parcel_stats = dict.fromkeys(stats_methods, np.nan)
+        parcel_stats['count'] = 0
+        return parcel_stats
+    # 10 and 90% percentiles (lower nearest rank) from a single
+    # partition instead of sorting the values
+    k10, k90 = int(0.1 * (v.size - 1)), int(0.9 * (v.size - 1))
+    v_part = np.partition(v, [k10, k90])
+    return {
+        'median': np.median(v),
+        'count': v.size,
+        'mean': np.mean(v),
+        'min': np.min(v),
+        'max': np.max(v),
+        'percentile_10': v_part[k10],
+        'percentile_90': v_part[k90],
+        'std': np.std(v),
+        'entropy': entropy(v),
+        'coefficient_of_variation': coefficient_of_variation(v)
+    }
+
+
+def _compute_scene_statistics(
+        fpath_lai: Path,
+        parcels_dir: Path
+) -> None:
+    """
+    Calculate the statistical measures for each parcel
+    of a single LAI scene.
+
+    Parameters
+    ----------
+    fpath_lai : Path
+        Path to the LAI scene (GeoTiff).
+    parcels_dir : Path
+        Path to the directory with the clipped parcel polygons.
+    """
+    # get the parcel polygons
+    scene = fpath_lai.stem.split('_lai')[0]
+    fpath_parcels = parcels_dir.joinpath(
+        scene + '.gpkg')
+    if not fpath_parcels.exists():
+        return
+
+    # read the LAI data (only the lai band)
+    with rasterio.open(fpath_lai) as src:
+        band_idx = 1
+        if 'lai' in src.descriptions:
+            band_idx = src.descriptions.index('lai') + 1
+        lai_values = src.read(
+            band_idx, out_dtype='float32', masked=True).filled(np.nan)
+        crs = src.crs.to_string()
+        transform = tuple(src.transform)[:6]
+    mtime = fpath_parcels.stat().st_mtime
+    gdf = _load_parcels(str(fpath_parcels), mtime, crs)
+
+    # calculate the statistics
+    try:
+        pixel_idxs, offsets = _parcel_pixel_index(
+            str(fpath_parcels), mtime, crs, transform, lai_values.shape)
+        lai_values = lai_values.ravel()
+        lai_stats = pd.DataFrame([
+            _parcel_statistics(
+                lai_values[pixel_idxs[offsets[idx]:offsets[idx + 1]]])
+            for idx in range(gdf.shape[0])], index=gdf.index)
+        # convert to GeoDataFrame
+        gdf_stats = gpd.GeoDataFrame(
+            pd.concat([gdf, lai_stats], axis=1),
+            geometry='geometry', crs=gdf.crs)
+
+        # save the statistics
+        fpath_stats = fpath_lai.parent.joinpath(
+            fpath_lai.stem + '_parcel_stats.gpkg')
+        gdf_stats.to_file(fpath_stats, driver='GPKG')
+    except Exception as e:
+        print(e)
+
+
+def _compute_group_statistics(
+        fpaths_lai: List[Path],
+        parcels_dir: Path
+) -> None:
+    """
+    Calculate the statistical measures for each parcel of LAI
+    scenes sharing the same parcel polygons. The scenes are
+    processed by the same worker so that the parcels are read
+    and rasterized only once (see `_load_parcels` and
+    `_parcel_pixel_index`).
+
+    Parameters
+    ----------
+    fpaths_lai : List[Path]
+        Paths to the LAI scenes (GeoTiff).
+    parcels_dir : Path
+        Path to the directory with the clipped parcel polygons.
+    """
+    for fpath_lai in fpaths_lai:
+        _compute_scene_statistics(fpath_lai, parcels_dir)
 
 
 def compute_parcel_statistics(
         data_dir: Path,
-        year: int
+        year: int,
+        max_workers: Optional[int] = None
 ) -> None:
     """
     Calculate the coefficient of variation, entropy and other
-    statistical measures for each parcel
+    statistical measures for each parcel. The LAI scenes are
+    processed in parallel, scenes sharing the same parcel
+    polygons by the same worker.
 
     Parameters
     ----------
@@ -93,7 +371,13 @@ def compute_parcel_statistics(
         Path to the directory with the satellite data.
     year : int
         Year of the satellite data.
+    max_workers : Optional[int]
+        Number of worker processes. Defaults to the number
+        of CPUs.
     """
+    # LAI files grouped by their parcel polygons (i.e., the scene
+    # and the directory with the clipped parcel polygons)
+    groups: Dict[Tuple[Path, str], List[Path]] = {}
     # loop over directories in sat_data_dir
     for sat_dir in data_dir.iterdir():
         sat_dir_year = sat_dir / str(year)
@@ -103,44 +387,28 @@ def compute_parcel_statistics(
         parcels_dir = sat_dir_year.joinpath('parcels')
 
         # loop over months
-        for month_dir in sat_dir_year.iterdir():
-            # directory with LAI data
-            lai_dir = month_dir.joinpath('lai')
-            # loop over lai files
-            for fpath_lai in lai_dir.glob('*.tif'):
-                # get the parcel polygons
-                scene = fpath_lai.stem.split('_lai')[0]
-                fpath_parcels = parcels_dir.joinpath(
-                    scene + '.gpkg')
-                if not fpath_parcels.exists():
-                    continue
-                gdf = gpd.read_file(fpath_parcels)
-
-                # read the LAI data
-                lai = RasterCollection.from_multi_band_raster(
-                    fpath_lai)['lai']
-                gdf.to_crs(lai.crs, inplace=True)
-
-                # calculate the statistics
-                try:
-                    lai_stats = lai.reduce(
-                        by=gdf,
-                        method=['median', 'count', 'mean', 'min', 'max',
-                                'percentile_10', 'percentile_90', 'std',
-                                entropy, coefficient_of_variation])
-                    # convert to GeoDataFrame
-                    gdf_stats = gpd.GeoDataFrame(
-                        lai_stats, geometry='geometry', crs=lai.crs)
-                    # drop the CRS column
-                    gdf_stats.drop(columns=['crs'], inplace=True)
-
-                    # save the statistics
-                    fpath_stats = lai_dir.joinpath(
-                        fpath_lai.stem + '_parcel_stats.gpkg')
-                    gdf_stats.to_file(fpath_stats, driver='GPKG')
-                except Exception as e:
-                    print(e)
+        with os.scandir(sat_dir_year) as entries:
+            for entry in entries:
+                if not (entry.is_dir() and
+                        month_folder_pattern.match(entry.name)):
                     continue
+                month_dir = Path(entry.path)
+                # directory with LAI data
+                lai_dir = month_dir.joinpath('lai')
+                # collect the lai files
+                for fpath_lai in lai_dir.glob('*.tif'):
+                    scene = fpath_lai.stem.split('_lai')[0]
+                    groups.setdefault(
+                        (parcels_dir, scene), []).append(fpath_lai)
+
+    # process the groups of LAI files in parallel
+    keys = list(groups.keys())
+    with ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count()) as executor:
+        list(executor.map(
+            _compute_group_statistics,
+            [groups[key] for key in keys],
+            [key[0] for key in keys]))
 
 
 def get_parcel_statistics(
@@ -164,36 +432,72 @@ def get_parcel_statistics(
         sat_dir_year = sat_dir / str(year)
         if not sat_dir_year.exists():
             continue
-        # loop over months
-        platform_stats_list = []
-        for month_dir in sat_dir_year.iterdir():
-            # loop over statistics files
-            for fpath_stats in month_dir.joinpath('lai').glob('*_parcel_stats.gpkg'):
-                # configuration of the LAI retrieval
-                config = fpath_stats.stem.split('_')[2]
-                # read the statistics
-                gdf_stats = gpd.read_file(fpath_stats)
-                # drop NaN values, i.e., where count is 0
-                gdf_stats = gdf_stats[gdf_stats['count'] > 0].copy()
-                gdf_stats['scene'] = fpath_stats.stem.split('_')[0]
-                gdf_stats['platform'] = platform
-                gdf_stats['month'] = month_dir.name
-                gdf_stats['config'] = config
-                gdf_stats.to_crs(common_crs, inplace=True)
-                platform_stats_list.append(gdf_stats)
+        # loop over months. The statistics are collected by their CRS
+        # and re-projected once per CRS after concatenating them
+        platform_stats_by_crs: Dict[str, List[gpd.GeoDataFrame]] = {}
+        with os.scandir(sat_dir_year) as entries:
+            for entry in entries:
+                if not (entry.is_dir() and
+                        month_folder_pattern.match(entry.name)):
+                    continue
+                month_dir = Path(entry.path)
+                # loop over statistics files
+                for fpath_stats in month_dir.joinpath('lai').glob(
+                        '*_parcel_stats.gpkg'):
+                    # configuration of the LAI retrieval
+                    config = fpath_stats.stem.split('_')[2]
+                    # read the statistics
+                    gdf_stats = read_dataframe(fpath_stats, use_arrow=True)
+                    gdf_stats['scene'] = fpath_stats.stem.split('_')[0]
+                    gdf_stats['platform'] = platform
+                    gdf_stats['month'] = month_dir.name
+                    gdf_stats['config'] = config
+                    # drop NaN values, i.e., where count is 0
+                    gdf_stats = gdf_stats[gdf_stats['count'] > 0]
+                    platform_stats_by_crs.setdefault(
+                        gdf_stats.crs.to_string(), []).append(gdf_stats)
 
         # concatenate the statistics
         platform_stats = gpd.GeoDataFrame(
-            pd.concat(platform_stats_list, ignore_index=True),
-            geometry='geometry', crs=gdf_stats.crs)
+            pd.concat([
+                pd.concat(crs_stats_list, ignore_index=True).to_crs(
+                    common_crs)
+                for crs_stats_list in platform_stats_by_crs.values()],
+                ignore_index=True),
+            geometry='geometry', crs=common_crs)
         # save as GeoPackage
         fpath_stats = sat_dir_year.joinpath(
             'parcel_statistics.gpkg')
         platform_stats.to_file(fpath_stats, driver='GPKG')
+        # and as GeoParquet for faster reads
+        platform_stats.to_parquet(
+            fpath_stats.with_suffix('.parquet'), compression='zstd',
+            index=False)
 
         print(f'Platform: {platform} ({year}) --> done')
 
 
+def _read_statistics(fpath: Path) -> pd.DataFrame:
+    """
+    Read the columns required for comparing LAI retrievals from
+    the aggregated parcel statistics. The GeoParquet file is
+    preferred over the GeoPackage if it exists.
+
+    Parameters
+    ----------
+    fpath : Path
+        Path to the aggregated parcel statistics (GeoPackage).
+    return : pd.DataFrame
+        Parcel statistics (without geometries).
+    """
+    fpath_parquet = fpath.with_suffix('.parquet')
+    if fpath_parquet.exists():
+        return pd.read_parquet(fpath_parquet, columns=compare_columns)
+    return read_dataframe(
+        fpath, columns=compare_columns, read_geometry=False,
+        use_arrow=True)
+
+
 def compare_planetscope_lai(
         fpath_planetscope: Path,
         out_dir: Path
@@ -208,8 +512,12 @@ def compare_planetscope_lai(
     out_dir : Path
         Path to the output directory.
     """
+    # plotting libraries are only imported when needed
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # read the file
-    gdf = gpd.read_file(fpath_planetscope)
+    gdf = _read_statistics(fpath_planetscope)
     # plot the coefficient of variation and the entropy
     # by config using seaborn
     sns.set_theme(style="whitegrid")
@@ -255,8 +563,12 @@ def compare_sentinel2_lai(
     out_dir : Path
         Path to the output directory.
     """
+    # plotting libraries are only imported when needed
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # read the file
-    gdf = gpd.read_file(fpath_sentinel2)
+    gdf = _read_statistics(fpath_sentinel2)
     # plot the coefficient of variation and the entropy
     # by config using seaborn
     sns.set_theme(style="whitegrid")
@@ -290,22 +602,56 @@ def compare_sentinel2_lai(
 
 if __name__ == '__main__':
 
-    year = 2022
-    data_dir = Path('data')
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Compute, aggregate and compare parcel statistics. '
+                    'If no step is selected, all steps are run.')
+    parser.add_argument(
+        '--compute', action='store_true',
+        help='compute the statistics per parcel and LAI scene')
+    parser.add_argument(
+        '--aggregate', action='store_true',
+        help='collect the statistics into a single file per platform')
+    parser.add_argument(
+        '--compare', nargs='*', choices=['planetscope', 'sentinel2'],
+        help='compare the LAI retrievals of the selected platforms '
+             '(all if none is given)')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--data-dir', type=Path, default=Path('data'))
+    args = parser.parse_args()
+
+    run_all = not (args.compute or args.aggregate or
+                   args.compare is not None)
+    year = args.year
+    data_dir = args.data_dir
 
     # compute the statistics
-    compute_parcel_statistics(data_dir, year)
+    if run_all or args.compute:
+        compute_parcel_statistics(data_dir, year)
 
     # and put them together
-    get_parcel_statistics(data_dir, year)
+    if run_all or args.aggregate:
+        get_parcel_statistics(data_dir, year)
+
+    compare = ['planetscope', 'sentinel2']
+    if args.compare:
+        compare = args.compare
+    elif not run_all and args.compare is None:
+        compare = []
 
     # compare PlanetScope 4 and 8 band LAI retrievals
-    fpath_planetscope = Path('data/planetscope/2022/parcel_statistics.gpkg')
-    out_dir = Path('analysis/planetscope_4_vs_8_bands')
-    compare_planetscope_lai(fpath_planetscope, out_dir)
+    if 'planetscope' in compare:
+        fpath_planetscope = data_dir.joinpath(
+            'planetscope', str(year), 'parcel_statistics.gpkg')
+        out_dir = Path('analysis/planetscope_4_vs_8_bands')
+        out_dir.mkdir(exist_ok=True, parents=True)
+        compare_planetscope_lai(fpath_planetscope, out_dir)
 
     # compare Sentinel2 10 and 20 m LAI retrievals
-    fpath_sentinel2 = Path('data/sentinel/2022/parcel_statistics.gpkg')
-    out_dir = Path('analysis/sentinel2_10_vs_20_m')
-    out_dir.mkdir(exist_ok=True, parents=True)
-    compare_sentinel2_lai(fpath_sentinel2, out_dir)
+    if 'sentinel2' in compare:
+        fpath_sentinel2 = data_dir.joinpath(
+            'sentinel', str(year), 'parcel_statistics.gpkg')
+        out_dir = Path('analysis/sentinel2_10_vs_20_m')
+        out_dir.mkdir(exist_ok=True, parents=True)
+        compare_sentinel2_lai(fpath_sentinel2, out_dir)
@@ -4,12 +4,14 @@ by creating scatter plots of the LAI values.
 """
 
 import numpy as np
-import mpl_scatter_density  # noqa: F401
+import matplotlib as mpl
 import matplotlib.pyplot as plt
+import rasterio
 
-from eodal.core.raster import RasterCollection
 from matplotlib.colors import LinearSegmentedColormap
 from pathlib import Path
+from rasterio.enums import Resampling
+from typing import Iterator, Optional, Tuple
 
 plt.style.use('bmh')
 
@@ -23,13 +25,239 @@ white_viridis = LinearSegmentedColormap.from_list('white_viridis', [
     (0.6, '#21a784'),
     (0.8, '#78d151'),
     (1, '#fde624'),
-], N=256)
+], N=64)
+# register the colormap once so that it is looked up by name
+try:
+    mpl.colormaps.register(cmap=white_viridis, name='white_viridis')
+except ValueError:
+    # already registered (module imported again)
+    pass
+# LAI range and bins of the density plot
+lai_range = (0., 8.)
+# (float32 like the LAI values so that binning does not upcast them)
+density_bins = np.linspace(lai_range[0], lai_range[1], 513, dtype='float32')
+# approximate size (pixels) of the difference maps (5 inch at 300 dpi)
+map_size = 1500
+
+
+def _lai_band_idx(src: rasterio.DatasetReader) -> int:
+    """
+    Get the index of the LAI band of a LAI map (band described as
+    'lai', the first band otherwise).
+
+    Parameters
+    ----------
+    src : rasterio.DatasetReader
+        Opened LAI map
+    return : int
+        Band index (starting at 1)
+    """
+    if 'lai' in src.descriptions:
+        return src.descriptions.index('lai') + 1
+    return 1
+
+
+def _read_lai_decimated(
+        fpath: Path,
+        max_size: int
+) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Read the LAI values of a LAI map at reduced resolution so that
+    the shorter side of the returned array has about `max_size`
+    pixels (or less, the map is not upsampled). Internal overviews
+    are used by GDAL if available.
+
+    Parameters
+    ----------
+    fpath : Path
+        Path to the LAI map
+    max_size : int
+        Target number of pixels of the shorter side
+    return : Tuple[np.ndarray, Tuple[float, float, float, float]]
+        LAI values with no-data set to NaN and the extent of the
+        map (left, right, bottom, top) in map coordinates
+    """
+    with rasterio.open(fpath) as src:
+        decim = max(1, min(src.width, src.height) // max_size)
+        lai = src.read(
+            _lai_band_idx(src),
+            out_shape=(src.height // decim, src.width // decim),
+            out_dtype='float32',
+            masked=True,
+            resampling=Resampling.average)
+        left, bottom, right, top = src.bounds
+    return lai.filled(np.nan), (left, right, bottom, top)
+
+
+def _paired_blocks(
+        src4: rasterio.DatasetReader,
+        src8: rasterio.DatasetReader
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read two LAI maps (4 and 8 bands) block by block at full
+    resolution.
+
+    Parameters
+    ----------
+    src4 : rasterio.DatasetReader
+        Opened LAI map from Planet-Scope with 4 bands
+    src8 : rasterio.DatasetReader
+        Opened LAI map from Planet-Scope with 8 bands
+    return : Iterator[Tuple[np.ndarray, np.ndarray]]
+        LAI values (4 and 8 bands) of the pixels of a block with
+        LAI values in both maps
+    """
+    band_idx_4, band_idx_8 = _lai_band_idx(src4), _lai_band_idx(src8)
+    for _, window in src4.block_windows(band_idx_4):
+        lai_4 = src4.read(
+            band_idx_4, window=window, out_dtype='float32',
+            masked=True).filled(np.nan)
+        lai_8 = src8.read(
+            band_idx_8, window=window, out_dtype='float32',
+            masked=True).filled(np.nan)
+        mask = np.isfinite(lai_4) & np.isfinite(lai_8)
+        yield lai_4[mask], lai_8[mask]
+
+
+def _coefficient_of_determination(
+        fpath_4_bands: Path,
+        fpath_8_bands: Path
+) -> Tuple[float, int]:
+    """
+    Coefficient of determination (squared Pearson's r) of two LAI
+    maps (4 and 8 bands) at full resolution. The maps are processed
+    block by block. The first pass calculates the means, the second
+    one the (centered) sums of products.
+
+    Parameters
+    ----------
+    fpath_4_bands : Path
+        Path to the LAI values from Planet-Scope with 4 bands
+    fpath_8_bands : Path
+        Path to the LAI values from Planet-Scope with 8 bands
+    return : Tuple[float, int]
+        R2 and number of pixels with LAI values in both maps
+    """
+    with rasterio.open(fpath_4_bands) as src4, \
+            rasterio.open(fpath_8_bands) as src8:
+        n, sum_4, sum_8 = 0, 0., 0.
+        for lai_4, lai_8 in _paired_blocks(src4, src8):
+            n += lai_4.size
+            sum_4 += lai_4.sum(dtype='float64')
+            sum_8 += lai_8.sum(dtype='float64')
+        if n == 0:
+            return np.nan, 0
+        mean_4, mean_8 = sum_4 / n, sum_8 / n
+        s_48, s_44, s_88 = 0., 0., 0.
+        for lai_4, lai_8 in _paired_blocks(src4, src8):
+            a = lai_4 - np.float32(mean_4)
+            b = lai_8 - np.float32(mean_8)
+            s_48 += float(a @ b)
+            s_44 += float(a @ a)
+            s_88 += float(b @ b)
+    r = s_48 / np.sqrt(s_44 * s_88)
+    return r * r, n
+
+
+def _difference_histogram(
+        fpath_4_bands: Path,
+        fpath_8_bands: Path,
+        bins: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Histogram of the differences between two LAI maps (4 minus 8
+    bands) at full resolution. The maps are processed block by
+    block so that the difference is never held in memory for the
+    entire map. The first pass finds the range of the differences,
+    the second one counts them.
+
+    Parameters
+    ----------
+    fpath_4_bands : Path
+        Path to the LAI values from Planet-Scope with 4 bands
+    fpath_8_bands : Path
+        Path to the LAI values from Planet-Scope with 8 bands
+    bins : int
+        Number of bins
+    return : Tuple[np.ndarray, np.ndarray]
+        Counts and bin edges
+    """
+    with rasterio.open(fpath_4_bands) as src4, \
+            rasterio.open(fpath_8_bands) as src8:
+        def _block_differences():
+            for lai_4, lai_8 in _paired_blocks(src4, src8):
+                lai_4 -= lai_8
+                yield lai_4
+
+        lo, hi = np.inf, -np.inf
+        for diff in _block_differences():
+            if diff.size > 0:
+                lo, hi = min(lo, diff.min()), max(hi, diff.max())
+        if lo > hi:
+            lo, hi = 0., 1.
+        edges = np.linspace(lo, hi, bins + 1)
+        counts = np.zeros(bins, dtype='int64')
+        for diff in _block_differences():
+            counts += np.histogram(diff, bins=edges)[0]
+    return counts, edges
+
+
+def _load_lai(fpath: Path, overview: Optional[int] = None) -> np.ndarray:
+    """
+    Read the LAI values of a LAI map.
+
+    Parameters
+    ----------
+    fpath : Path
+        Path to the LAI map
+    overview : Optional[int]
+        Read the map at a resolution reduced by a factor of
+        2**overview (averaging the pixels). Internal overviews
+        are used by GDAL if available. Full resolution if None
+        (default).
+    return : np.ndarray
+        LAI values with no-data set to NaN
+    """
+    with rasterio.open(fpath) as src:
+        f = 1 if overview is None else 2**overview
+        lai = src.read(
+            _lai_band_idx(src),
+            out_shape=(max(1, src.height // f), max(1, src.width // f)),
+            out_dtype='float32',
+            masked=True,
+            resampling=Resampling.average)
+    return lai.filled(np.nan)
+
+
+def _get_axes(
+        fig: Optional[plt.Figure],
+        figsize: Tuple[float, float]
+) -> Tuple[plt.Figure, plt.Axes]:
+    """
+    Get a figure with a single axes. A figure passed is cleared
+    and reused instead of creating a new one.
+
+    Parameters
+    ----------
+    fig : Optional[plt.Figure]
+        Figure to reuse or None to create a new figure
+    figsize : Tuple[float, float]
+        Size of a new figure (inches)
+    return : Tuple[plt.Figure, plt.Axes]
+        Figure and axes
+    """
+    if fig is None:
+        fig = plt.Figure(figsize=figsize)
+    else:
+        fig.clear()
+    return fig, fig.add_subplot(1, 1, 1)
 
 
 def lai_scatter(
         fpath_4_bands: Path,
         fpath_8_bands: Path,
-        output_dir: Path) -> None:
+        output_dir: Path,
+        fig: Optional[plt.Figure] = None) -> None:
     """
     Create scatter plots of LAI values from Planet-Scope
     with 4 and 8 bands.
@@ -42,46 +270,56 @@ def lai_scatter(
         Path to the LAI values from Planet-Scope with 8 bands
     output_dir : Path
         Path to the output directory
+    fig : Optional[plt.Figure]
+        Figure to reuse for the plot (e.g., when plotting many
+        scenes). A new figure is created if None (default).
     """
-    # read the LAI values
-    lai_4bands = RasterCollection.from_multi_band_raster(
-        fpath_4_bands)['lai'].values
-    lai_8bands = RasterCollection.from_multi_band_raster(
-        fpath_8_bands)['lai'].values
-
-    # calculate R2
-    lai_4bands_nonan = lai_4bands[~np.isnan(lai_4bands)]
-    lai_8bands_nonan = lai_8bands[~np.isnan(lai_8bands)]
-    r2 = np.corrcoef(
-        lai_4bands_nonan, lai_8bands_nonan)[0, 1]**2
-
-    # make a scatter plot and color the points by density
-    fig = plt.Figure(figsize=(6, 6))
-    ax = fig.add_subplot(1, 1, 1, projection='scatter_density')
-    density = ax.scatter_density(
-        lai_4bands_nonan,
-        lai_8bands_nonan,
-        cmap=white_viridis)
-    fig.colorbar(density, label='Density')
+    # calculate R2 on the pixels with LAI values in both maps
+    # (at full resolution)
+    r2, n_pixels = _coefficient_of_determination(fpath_4_bands, fpath_8_bands)
+
+    # read the LAI values at half resolution (a quarter of the
+    # pixels is enough for the density)
+    lai_4bands = _load_lai(fpath_4_bands, overview=1).ravel()
+    lai_8bands = _load_lai(fpath_8_bands, overview=1).ravel()
+    mask = np.isfinite(lai_4bands) & np.isfinite(lai_8bands)
+    lai_4bands_nonan = lai_4bands[mask]
+    lai_8bands_nonan = lai_8bands[mask]
+
+    # make a scatter plot and color the points by density. The
+    # density is binned once instead of plotting every pixel
+    density, _, _ = np.histogram2d(
+        lai_4bands_nonan, lai_8bands_nonan,
+        bins=[density_bins, density_bins])
+    fig, ax = _get_axes(fig, (6, 6))
+    im = ax.imshow(
+        np.log1p(density.astype('float32')).T,
+        origin='lower',
+        extent=[lai_range[0], lai_range[1], lai_range[0], lai_range[1]],
+        cmap='white_viridis',
+        interpolation='nearest')
+    fig.colorbar(
+        im, ax=ax, label='log(1 + Density) (2x2 averaged pixels)')
     ax.set_xlabel(r'Planet SuperDove LAI 4 bands [m$^2$ m$^{-2}$]')
     ax.set_ylabel(r'Planet SuperDove LAI 8 bands [m$^2$ m$^{-2}$]')
-    ax.set_xlim(0, 8)
-    ax.set_ylim(0, 8)
+    ax.set_xlim(*lai_range)
+    ax.set_ylim(*lai_range)
     ax.set_aspect('equal')
     ax.set_title(r'$R^2$ = ' + str(np.round(r2, 2)) +
-                 f'; N = {lai_4bands.size}')
+                 f'; N = {n_pixels}')
 
     # save the figure
     scene = fpath_4_bands.stem.split('_')[0]
     fpath = output_dir / f'{scene}_lai_4_vs_8_bands.png'
     fig.savefig(fpath, dpi=300)
-    plt.close(fig)
 
 
 def lai_difference_maps(
         fpath_4_bands: Path,
         fpath_8_bands: Path,
-        output_dir: Path) -> None:
+        output_dir: Path,
+        fig_map: Optional[plt.Figure] = None,
+        fig_hist: Optional[plt.Figure] = None) -> None:
     """
     Create difference maps of LAI values from Planet-Scope
     with 4 and 8 bands.
@@ -94,51 +332,62 @@ def lai_difference_maps(
         Path to the LAI values from Planet-Scope with 8 bands
     output_dir : Path
         Path to the output directory
+    fig_map : Optional[plt.Figure]
+        Figure to reuse for the difference map. A new figure
+        is created if None (default).
+    fig_hist : Optional[plt.Figure]
+        Figure to reuse for the histogram of the differences.
+        A new figure is created if None (default).
     """
 
-    # read the LAI values
-    lai_4bands = RasterCollection.from_multi_band_raster(
-        fpath_4_bands)['lai']
-    lai_8bands = RasterCollection.from_multi_band_raster(
-        fpath_8_bands)['lai']
-
-    # calculate the difference (8 minus 4 band LAI)
-    lai_diff = lai_4bands - lai_8bands
+    # read the LAI values at the resolution of the figure and
+    # calculate the difference (4 minus 8 band LAI) in place
+    lai_diff, extent = _read_lai_decimated(fpath_4_bands, map_size)
+    np.subtract(
+        lai_diff, _read_lai_decimated(fpath_8_bands, map_size)[0],
+        out=lai_diff)
 
     # plot the differences with a diverging color map
-    fig, ax = plt.subplots(figsize=(5, 5))
-    lai_diff.plot(
-        colormap='coolwarm',
-        colorbar_label=r'Difference in LAI [$m^2$ $m^{-2}$]',
-        ax=ax
-    )
+    fig, ax = _get_axes(fig_map, (5, 5))
+    im = ax.imshow(
+        lai_diff, cmap='coolwarm', interpolation='nearest', extent=extent)
+    fig.colorbar(im, ax=ax, label=r'Difference in LAI [$m^2$ $m^{-2}$]')
     ax.set_title('PlanetScope 4-band LAI minus 8-band LAI')
 
     # save the figure
     scene = fpath_4_bands.stem.split('_')[0]
     fname = output_dir / f'{scene}_lai_4_minus_8_bands.png'
     fig.savefig(fname, dpi=300, bbox_inches='tight')
-    plt.close(fig)
 
-    # histogram of differences
-    fig, ax = plt.subplots(figsize=(5,5))
-    lai_diff.hist(bins=100, ax=ax)
+    # histogram of differences (at full resolution)
+    counts, edges = _difference_histogram(fpath_4_bands, fpath_8_bands, 100)
+    fig, ax = _get_axes(fig_hist, (5, 5))
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge')
     ax.set_xlabel(r'Difference in LAI [$m^2$ $m^{-2}$]')
     fname = output_dir / f'{scene}_lai_4_minus_8_bands_hist.png'
     fig.savefig(fname, dpi=300, bbox_inches='tight')
-    plt.close(fig)
 
 
 if __name__ == '__main__':
 
-    fpath_4bands = Path(
-        'data/planetscope/2022/09_sep/lai/0128_lai_4bands.tif')
-    fpath_8bands = Path(
-        'data/planetscope/2022/09_sep/lai/0128_lai_8bands.tif')
+    lai_dir = Path('data/planetscope/2022/09_sep/lai')
 
     output_dir = Path('analysis/planetscope_4_vs_8_bands')
     output_dir.mkdir(exist_ok=True, parents=True)
 
-    lai_difference_maps(fpath_4bands, fpath_8bands, output_dir)
+    # the figures are reused for all scenes
+    fig_map = plt.Figure(figsize=(5, 5))
+    fig_hist = plt.Figure(figsize=(5, 5))
+    fig_scatter = plt.Figure(figsize=(6, 6))
+
+    for fpath_4bands in sorted(lai_dir.glob('*_lai_4bands.tif')):
+        fpath_8bands = fpath_4bands.with_name(
+            fpath_4bands.name.replace('_lai_4bands', '_lai_8bands'))
+        if not fpath_8bands.exists():
+            continue
+
+        lai_difference_maps(
+            fpath_4bands, fpath_8bands, output_dir,
+            fig_map=fig_map, fig_hist=fig_hist)
 
-    lai_scatter(fpath_4bands, fpath_8bands, output_dir)
+        lai_scatter(fpath_4bands, fpath_8bands, output_dir, fig=fig_scatter)
@@ -5,32 +5,57 @@ image tiles and save them as geopackage files.
 """
 
 import geopandas as gpd
+import os
+import rasterio
 
-from eodal.core.raster import RasterCollection
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from pyproj import CRS, Transformer
+from shapely.geometry import box
+from shapely.ops import transform
+from typing import Any, Optional
 
+from rtm_inv.core.utils import month_folder_pattern
 
-def get_bbox(fpath: Path) -> gpd.GeoDataFrame:
+
+def get_bbox(
+        fpath: Path,
+        crs: Optional[Any] = None
+) -> gpd.GeoDataFrame:
     """
-    Get the bounding box of a raster file.
+    Get the bounding box of a raster file. Only the header of
+    the file is read.
 
     Parameters
     ----------
     fpath : Path
         Path to the raster file.
+    crs : Optional[Any]
+        CRS to re-project the bounding box to. If None (default)
+        the CRS of the raster file is kept.
     return : gpd.GeoDataFrame
         GeoDataFrame with the bounding box as geometry.
     """
-    rc = RasterCollection.from_multi_band_raster(fpath)
-    epsg = rc[rc.band_names[0]].geo_info.epsg
-    bounds = rc[rc.band_names[0]].bounds
-    return gpd.GeoDataFrame(geometry=[bounds], crs=f'EPSG:{epsg}')
-
-
-def main(sat_data_dir: Path, fpath_parcels: Path, year: int) -> None:
+    with rasterio.open(fpath) as src:
+        src_crs = CRS.from_user_input(src.crs.to_wkt())
+        bounds = box(*src.bounds)
+    if crs is None or CRS.from_user_input(crs) == src_crs:
+        return gpd.GeoDataFrame(geometry=[bounds], crs=src_crs)
+    transformer = Transformer.from_crs(src_crs, crs, always_xy=True)
+    return gpd.GeoDataFrame(
+        geometry=[transform(transformer.transform, bounds)], crs=crs)
+
+
+def main(
+        sat_data_dir: Path,
+        fpath_parcels: Path,
+        year: int,
+        max_workers: Optional[int] = 16
+) -> None:
     """
     Clip field parcel polygons to the extent of the
     image tiles and save them as geopackage files.
+    The scenes are processed in parallel threads.
 
     Parameters
     ----------
@@ -38,13 +63,37 @@ def main(sat_data_dir: Path, fpath_parcels: Path, year: int) -> None:
         Path to the directory with the satellite data.
     fpath_parcels : Path
         Path to the field parcel polygons.
+    year : int
+        Year of the satellite data.
+    max_workers : Optional[int]
+        Number of threads. Default is 16.
     """
-    # read the parcel polygons
-    gdf = gpd.read_file(fpath_parcels)
-    epsg = gdf.crs.to_epsg()
-
+    # read the parcel polygons and build their spatial index once
+    gdf = gpd.read_file(fpath_parcels, engine='pyogrio', use_arrow=True)
+    sindex = gdf.sindex
+
+    def _clip_one(fpath_scene: Path, output_dir_parcels: Path) -> str:
+        # get the bounding box of the scenes
+        bbox = get_bbox(fpath_scene, crs=gdf.crs)
+        # clip the parcel polygons to the extent of the scene
+        # (only those intersecting the scene are clipped)
+        idx = sindex.query(bbox.geometry.iloc[0], predicate='intersects')
+        if len(idx) == 0:
+            return f'No parcel polygons for {fpath_scene.stem}'
+        gdf_clip = gpd.clip(gdf.iloc[idx], bbox)
+        if gdf_clip.empty:
+            return f'No parcel polygons for {fpath_scene.stem}'
+        # save the parcel polygons as geopackage
+        fpath_out = output_dir_parcels.joinpath(
+            f'{fpath_scene.stem}.gpkg')
+        gdf_clip.to_file(fpath_out, driver='GPKG', engine='pyogrio')
+        return f'Clipped parcel polygons for {fpath_scene.stem}'
+
+    scenes, output_dirs = [], []
     # loop over directories in sat_data_dir
-    for sat_dir in sat_data_dir.iterdir():
+    with os.scandir(sat_data_dir) as sat_entries:
+        sat_dirs = [Path(e.path) for e in sat_entries if e.is_dir()]
+    for sat_dir in sat_dirs:
         sat_dir_year = sat_dir / str(year)
         if not sat_dir_year.exists():
             continue
@@ -53,27 +102,32 @@ def main(sat_data_dir: Path, fpath_parcels: Path, year: int) -> None:
         output_dir_parcels = sat_dir_year.joinpath('parcels')
         output_dir_parcels.mkdir(parents=True, exist_ok=True)
         # loop over months
-        for month_dir in sat_dir_year.iterdir():
-            # loop over scenes
-            for fpath_scene in month_dir.joinpath('data').glob('*.tif'):
-                # get the bounding box of the scenes
-                bbox = get_bbox(fpath_scene)
-                bbox = bbox.to_crs(epsg=epsg)
-                # clip the parcel polygons to the extent of the scene
-                gdf_clip = gpd.clip(gdf, bbox)
-                if gdf_clip.empty:
-                    continue
-                # save the parcel polygons as geopackage
-                fpath_out = output_dir_parcels.joinpath(
-                    f'{fpath_scene.stem}.gpkg')
-                gdf_clip.to_file(fpath_out, driver='GPKG')
-
-                print(f'Clipped parcel polygons for {fpath_scene.stem}')
+        with os.scandir(sat_dir_year) as entries:
+            month_dirs = [
+                entry.path for entry in entries
+                if entry.is_dir() and month_folder_pattern.match(entry.name)]
+        for month_dir in month_dirs:
+            data_dir = os.path.join(month_dir, 'data')
+            if not os.path.isdir(data_dir):
+                continue
+            # collect the scenes
+            with os.scandir(data_dir) as scene_entries:
+                for scene_entry in scene_entries:
+                    if scene_entry.is_file() and \
+                            scene_entry.name.endswith('.tif'):
+                        scenes.append(Path(scene_entry.path))
+                        output_dirs.append(output_dir_parcels)
 
             # we don't need to loop over the other months
             # because the parcels are the same for each month
             break
 
+    # reading the scene headers and writing the geopackages is
+    # mostly I/O, thus threads are sufficient
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for status in executor.map(_clip_one, scenes, output_dirs):
+            print(status)
+
 
 if __name__ == '__main__':
 
@@ -23,7 +23,13 @@ import numpy as np
 import pandas as pd
 
 from numba import njit, prange
-from typing import List, Optional, Tuple
+from scipy.spatial import cKDTree
+from typing import List, Optional, Tuple, Union
+
+# scaling factor for quantizing reflectance factors to int16
+reflectance_scale = 10000
+# methods available in `inv_img_compact`
+inversion_methods: List[str] = ['numba', 'gemm', 'int16', 'kdtree']
 
 @njit(parallel=True, cache=True)
 def inv_img(
@@ -93,12 +99,586 @@ def inv_img(
                 elif cost_function == 'squared_sum_of_differences':
                     delta[idx] = np.sum((lut[idx,:] - image_ref)**2)
             # find the smallest errors between simulated and observed spectra
-            # we need the row index of the corresponding entries in the LUT
-            delta_sorted = np.argsort(delta)
+            # we need the row index of the corresponding entries in the LUT.
+            # Partitioning is O(n), only the n best solutions are sorted
+            threshold = np.partition(delta, n_solutions - 1)[n_solutions - 1]
+            candidates = np.nonzero(delta <= threshold)[0]
+            delta_sorted = candidates[np.argsort(delta[candidates])]
             lut_idxs[:,row,col] = delta_sorted[0:n_solutions]
             cost_function_values[:,row,col] = delta[delta_sorted[0:n_solutions]]
     return lut_idxs, cost_function_values
 
+@njit(cache=True)
+def _heap_sift_down(
+        heap_costs: np.ndarray,
+        heap_idxs: np.ndarray,
+        pos: int,
+        size: int
+    ) -> None:
+    """
+    Restores the max-heap property of `heap_costs` (and the attached
+    `heap_idxs`) below position `pos` considering the first `size`
+    entries only. The root of the heap is the worst (largest) cost.
+    """
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and heap_costs[child + 1] > heap_costs[child]:
+            child += 1
+        if heap_costs[child] <= heap_costs[pos]:
+            break
+        heap_costs[pos], heap_costs[child] = heap_costs[child], heap_costs[pos]
+        heap_idxs[pos], heap_idxs[child] = heap_idxs[child], heap_idxs[pos]
+        pos = child
+
+@njit(cache=True)
+def _heap_sort(
+        heap_costs: np.ndarray,
+        heap_idxs: np.ndarray
+    ) -> None:
+    """
+    Sorts a max-heap (and the attached `heap_idxs`) in place in
+    ascending order of `heap_costs`.
+    """
+    for end in range(heap_costs.size - 1, 0, -1):
+        heap_costs[0], heap_costs[end] = heap_costs[end], heap_costs[0]
+        heap_idxs[0], heap_idxs[end] = heap_idxs[end], heap_idxs[0]
+        _heap_sift_down(heap_costs, heap_idxs, 0, end)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def inv_pixels_rmse(
+        lut: np.ndarray,
+        pixels: np.ndarray,
+        n_solutions: int,
+        lut_idxs: np.ndarray,
+        cost_function_values: np.ndarray
+    ) -> None:
+    """
+    Lookup-table based inversion of single pixel spectra using the RMSE
+    as cost function. Other than `inv_img`, the *n* best solutions are
+    tracked per pixel in a bounded max-heap so that no cost function
+    array of the size of the LUT has to be allocated and sorted for
+    every pixel.
+
+    The LUT must be sorted in ascending order by its first band (see
+    `sort_lut`). The search starts at the LUT row closest to the pixel
+    in the first band and walks outwards in both directions. A direction
+    is abandoned as soon as the difference in the first band alone
+    exceeds the worst of the best solutions found so far, and the sum
+    over the bands is stopped as soon as it does.
+
+    :param lut:
+        LUT with synthetic (i.e., RTM-simulated) spectra in the
+        spectral resolution of the sensor used sorted by the first band.
+        The shape of the LUT must equal (num_spectra, num_bands). Should
+        be a C-contiguous `float32` array.
+    :param pixels:
+        sensor spectra of shape (num_pixels, num_bands). Should be a
+        C-contiguous array with the same dtype as `lut`.
+    :param n_solutions:
+        number of best solutions to return (where cost function is
+        minimal). Must not be larger than the number of spectra in
+        the `lut`.
+    :param lut_idxs:
+        `int32` array of shape `(num_pixels, n_solutions)` the row
+        indices of the best solutions in the `lut` are written to
+        (sorted by increasing cost function value).
+    :param cost_function_values:
+        `float32` array of shape `(num_pixels, n_solutions)` the
+        corresponding RMSE values are written to.
+    """
+    n_spectra, n_bands = lut.shape
+    first_band = np.ascontiguousarray(lut[:,0])
+
+    for pixel in prange(pixels.shape[0]):
+        # get sensor spectrum (single pixel)
+        image_ref = pixels[pixel]
+        # the heap stores the sum of squared differences; the root is
+        # the worst of the best solutions found so far
+        heap_costs = np.empty(n_solutions, dtype=lut.dtype)
+        heap_idxs = np.empty(n_solutions, dtype=np.int32)
+        # rows above and below the pixel value in the first band
+        upper = np.searchsorted(first_band, image_ref[0])
+        lower = upper - 1
+        # fill the heap with the rows closest in the first band
+        for solution in range(n_solutions):
+            if lower < 0:
+                idx = upper
+                upper += 1
+            elif upper >= n_spectra:
+                idx = lower
+                lower -= 1
+            elif image_ref[0] - first_band[lower] <= \
+                    first_band[upper] - image_ref[0]:
+                idx = lower
+                lower -= 1
+            else:
+                idx = upper
+                upper += 1
+            delta = 0.
+            for band in range(n_bands):
+                diff = lut[idx,band] - image_ref[band]
+                delta += diff * diff
+            heap_costs[solution] = delta
+            heap_idxs[solution] = idx
+        for pos in range(n_solutions // 2 - 1, -1, -1):
+            _heap_sift_down(heap_costs, heap_idxs, pos, n_solutions)
+        # scan the remaining spectra and replace the root whenever
+        # a better solution is found
+        while upper < n_spectra:
+            diff = first_band[upper] - image_ref[0]
+            delta = diff * diff
+            if delta >= heap_costs[0]:
+                break
+            for band in range(1, n_bands):
+                diff = lut[upper,band] - image_ref[band]
+                delta += diff * diff
+                if delta >= heap_costs[0]:
+                    break
+            if delta < heap_costs[0]:
+                heap_costs[0] = delta
+                heap_idxs[0] = upper
+                _heap_sift_down(heap_costs, heap_idxs, 0, n_solutions)
+            upper += 1
+        while lower >= 0:
+            diff = first_band[lower] - image_ref[0]
+            delta = diff * diff
+            if delta >= heap_costs[0]:
+                break
+            for band in range(1, n_bands):
+                diff = lut[lower,band] - image_ref[band]
+                delta += diff * diff
+                if delta >= heap_costs[0]:
+                    break
+            if delta < heap_costs[0]:
+                heap_costs[0] = delta
+                heap_idxs[0] = lower
+                _heap_sift_down(heap_costs, heap_idxs, 0, n_solutions)
+            lower -= 1
+        # heap-sort so that the best solution comes first
+        _heap_sort(heap_costs, heap_idxs)
+        for solution in range(n_solutions):
+            lut_idxs[pixel,solution] = heap_idxs[solution]
+            cost_function_values[pixel,solution] = \
+                np.sqrt(heap_costs[solution] / n_bands)
+
+def sort_lut(
+        lut: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Prepares a LUT for `inv_pixels_rmse`. The bands are reordered by
+    decreasing variance (for vegetation usually starting with the NIR)
+    and the rows are sorted by the band with the highest variance.
+
+    :param lut:
+        LUT with synthetic (i.e., RTM-simulated) spectra of shape
+        (num_spectra, num_bands).
+    :returns:
+        tuple with the sorted, C-contiguous `float32` LUT, the original
+        row index of every sorted row and the band order. Sensor spectra
+        must be reordered using the band order as well.
+    """
+    lut = np.asarray(lut, dtype=np.float32)
+    band_order = np.argsort(lut.var(axis=0))[::-1]
+    lut = lut[:, band_order]
+    row_order = np.argsort(lut[:, 0], kind='stable').astype('int32')
+    return np.ascontiguousarray(lut[row_order]), row_order, band_order
+
+@njit(parallel=True, cache=True)
+def inv_pixels_ssd_int16(
+        lut: np.ndarray,
+        pixels: np.ndarray,
+        n_solutions: int,
+        lut_idxs: np.ndarray,
+        sum_squared_differences: np.ndarray
+    ) -> None:
+    """
+    Same as `inv_pixels_rmse` but on reflectance values quantized to
+    `int16` (see `quantize_reflectance`). The sum of squared differences
+    is accumulated in integer arithmetic, which is monotonic in the RMSE
+    and therefore yields the same ranking of the solutions.
+
+    :param lut:
+        quantized LUT spectra of shape (num_spectra, num_bands).
+    :param pixels:
+        quantized sensor spectra of shape (num_pixels, num_bands).
+    :param n_solutions:
+        number of best solutions to return (where cost function is
+        minimal). Must not be larger than the number of spectra in
+        the `lut`.
+    :param lut_idxs:
+        `int32` array of shape `(num_pixels, n_solutions)` the row
+        indices of the best solutions in the `lut` are written to
+        (sorted by increasing cost function value).
+    :param sum_squared_differences:
+        `int64` array of shape `(num_pixels, n_solutions)` the
+        corresponding sum of squared differences are written to.
+    """
+    n_spectra, n_bands = lut.shape
+
+    for pixel in prange(pixels.shape[0]):
+        # get sensor spectrum (single pixel)
+        image_ref = pixels[pixel].astype(np.int64)
+        # the heap stores the sum of squared differences; the root is
+        # the worst of the best solutions found so far
+        heap_costs = np.empty(n_solutions, dtype=np.int64)
+        heap_idxs = np.empty(n_solutions, dtype=np.int32)
+        for idx in range(n_solutions):
+            delta = 0
+            for band in range(n_bands):
+                diff = np.int64(lut[idx,band]) - image_ref[band]
+                delta += diff * diff
+            heap_costs[idx] = delta
+            heap_idxs[idx] = idx
+        for pos in range(n_solutions // 2 - 1, -1, -1):
+            _heap_sift_down(heap_costs, heap_idxs, pos, n_solutions)
+        # scan the remaining spectra and replace the root whenever
+        # a better solution is found
+        for idx in range(n_solutions, n_spectra):
+            delta = 0
+            for band in range(n_bands):
+                diff = np.int64(lut[idx,band]) - image_ref[band]
+                delta += diff * diff
+            if delta < heap_costs[0]:
+                heap_costs[0] = delta
+                heap_idxs[0] = idx
+                _heap_sift_down(heap_costs, heap_idxs, 0, n_solutions)
+        # heap-sort so that the best solution comes first
+        _heap_sort(heap_costs, heap_idxs)
+        for solution in range(n_solutions):
+            lut_idxs[pixel,solution] = heap_idxs[solution]
+            sum_squared_differences[pixel,solution] = heap_costs[solution]
+
+def quantize_reflectance(
+        refl: np.ndarray,
+        scale: Optional[float] = reflectance_scale
+    ) -> np.ndarray:
+    """
+    Quantizes reflectance factors in the range [0, 1] to `int16`
+    by multiplying them with `scale` (10000 by default, i.e., four
+    decimal places are kept). Values outside the range of `int16`
+    (e.g., saturated pixels) are clipped instead of wrapping around.
+
+    :param refl:
+        reflectance factors (must not contain NaNs)
+    :param scale:
+        scaling factor
+    :returns:
+        `int16` array of the same shape as `refl`
+    """
+    quantized = np.round(np.asarray(refl) * scale)
+    if np.isnan(quantized).any():
+        raise ValueError('Reflectance factors must not contain NaNs')
+    info = np.iinfo(np.int16)
+    np.clip(quantized, info.min, info.max, out=quantized)
+    return quantized.astype(np.int16)
+
+def inv_pixels_gemm(
+        lut: np.ndarray,
+        pixels: np.ndarray,
+        n_solutions: int,
+        block_size: Optional[int] = 256
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lookup-table based inversion of single pixel spectra using the RMSE
+    as cost function. The squared distances between a block of pixels
+    and all LUT spectra are computed at once by expanding
+    ||l - p||^2 = ||l||^2 + ||p||^2 - 2 l.p, so that the bulk of the
+    work is a single matrix multiplication handled by BLAS.
+
+    :param lut:
+        LUT with synthetic (i.e., RTM-simulated) spectra in the
+        spectral resolution of the sensor used. The shape of the LUT
+        must equal (num_spectra, num_bands). Should be a C-contiguous
+        `float32` array.
+    :param pixels:
+        sensor spectra of shape (num_pixels, num_bands). Should be a
+        C-contiguous array with the same dtype as `lut`.
+    :param n_solutions:
+        number of best solutions to return (where cost function is
+        minimal)
+    :param block_size:
+        number of pixels processed at once. The distance matrix of a
+        block has `block_size * num_spectra` entries, i.e., about 50 MB
+        for the default of 256 pixels and a LUT with 50000 spectra.
+    :returns:
+        tuple with two ``np.ndarray`` of shape `(num_pixels, n_solutions)`
+        where for each pixel the `n_solutions` best solutions are
+        returned as row indices in the `lut` in the first tuple element
+        and the corresponding cost function values in the second.
+    """
+    n_pixels, n_bands = pixels.shape
+    lut_idxs = np.empty((n_pixels, n_solutions), dtype='int32')
+    cost_function_values = np.empty((n_pixels, n_solutions), dtype='float32')
+    lut_sqn = np.einsum('ij,ij->i', lut, lut)
+
+    for start in range(0, n_pixels, block_size):
+        block = pixels[start:start + block_size]
+        # squared distances of shape (block_size, num_spectra)
+        delta = block @ lut.T
+        delta *= -2.
+        delta += lut_sqn[np.newaxis, :]
+        delta += np.einsum('ij,ij->i', block, block)[:, np.newaxis]
+        # select the n best solutions and sort them only
+        best = np.argpartition(delta, n_solutions - 1, axis=1)
+        best = best[:, :n_solutions]
+        best_delta = np.take_along_axis(delta, best, axis=1)
+        order = np.argsort(best_delta, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_delta = np.take_along_axis(best_delta, order, axis=1)
+        # rounding might result in slightly negative distances
+        np.maximum(best_delta, 0., out=best_delta)
+        lut_idxs[start:start + block_size] = best
+        cost_function_values[start:start + block_size] = \
+            np.sqrt(best_delta / n_bands)
+    return lut_idxs, cost_function_values
+
+def inv_pixels_kdtree(
+        tree: cKDTree,
+        pixels: np.ndarray,
+        n_solutions: int,
+        block_size: Optional[int] = 1024,
+        workers: Optional[int] = -1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lookup-table based inversion of single pixel spectra using the RMSE
+    as cost function. The LUT is indexed by a k-d tree which is queried
+    for the `n_solutions` nearest neighbors of every pixel spectrum
+    using all available cores by default.
+
+    :param tree:
+        k-d tree built from the LUT with synthetic (i.e., RTM-simulated)
+        spectra in the spectral resolution of the sensor used (see
+        `PreparedLUT`).
+    :param pixels:
+        sensor spectra of shape (num_pixels, num_bands).
+    :param n_solutions:
+        number of best solutions to return (where cost function is
+        minimal)
+    :param block_size:
+        number of pixels queried at once to limit the size of the
+        (float64) query results.
+    :param workers:
+        number of threads used for querying the tree (-1 to use all
+        cores).
+    :returns:
+        tuple with two ``np.ndarray`` of shape `(num_pixels, n_solutions)`
+        where for each pixel the `n_solutions` best solutions are
+        returned as row indices in the `lut` in the first tuple element
+        and the corresponding cost function values in the second.
+    """
+    n_pixels, n_bands = pixels.shape
+    lut_idxs = np.empty((n_pixels, n_solutions), dtype='int32')
+    cost_function_values = np.empty((n_pixels, n_solutions), dtype='float32')
+    for start in range(0, n_pixels, block_size):
+        dist, idx = tree.query(
+            pixels[start:start + block_size], k=n_solutions, workers=workers)
+        # the query returns 1-d arrays if only a single solution is asked for
+        dist = dist.reshape(-1, n_solutions)
+        idx = idx.reshape(-1, n_solutions)
+        lut_idxs[start:start + block_size] = idx
+        # convert the Euclidean distance to RMSE
+        cost_function_values[start:start + block_size] = \
+            dist / np.sqrt(n_bands)
+    return lut_idxs, cost_function_values
+
+class PreparedLUT(object):
+    """
+    LUT prepared once for the inversion method chosen so that it can be
+    used for inverting many images (e.g., all scenes sharing the same
+    LUT) with `inv_img_compact`.
+
+    :attrib method:
+        inversion method the LUT was prepared for
+    :attrib lut:
+        LUT in the layout required by the method (sorted for 'numba',
+        quantized for 'int16', `float32` for 'gemm')
+    :attrib n_spectra:
+        number of spectra in the LUT
+    :attrib row_order:
+        original row index of every row in `lut` ('numba' only)
+    :attrib band_order:
+        order of the bands in `lut` ('numba' only)
+    :attrib tree:
+        k-d tree of the LUT ('kdtree' only)
+    :attrib workers:
+        number of threads used for querying the tree ('kdtree' only)
+    """
+    def __init__(
+            self,
+            lut: np.ndarray,
+            method: Optional[str] = 'numba',
+            workers: Optional[int] = -1
+        ):
+        """
+        creates a new ``PreparedLUT`` instance
+
+        :param lut:
+            LUT with synthetic (i.e., RTM-simulated) spectra in the
+            spectral resolution of the sensor used. The shape of the LUT
+            must equal (num_spectra, num_bands).
+        :param method:
+            one of `inversion_methods`
+        :param workers:
+            number of threads used for querying the k-d tree ('kdtree'
+            only, -1 to use all cores)
+        """
+        if method not in inversion_methods:
+            raise ValueError(f'Method {method} is not available')
+        self.method = method
+        self.n_spectra = lut.shape[0]
+        self.row_order = None
+        self.band_order = None
+        self.tree = None
+        self.workers = workers
+        if method == 'numba':
+            self.lut, self.row_order, self.band_order = sort_lut(lut)
+        elif method == 'int16':
+            self.lut = quantize_reflectance(lut)
+        elif method == 'gemm':
+            self.lut = np.ascontiguousarray(lut, dtype=np.float32)
+        else:
+            self.lut = np.asarray(lut)
+            self.tree = cKDTree(
+                self.lut, leafsize=32, compact_nodes=True, balanced_tree=True)
+
+def inv_img_compact(
+        lut: Union[np.ndarray, PreparedLUT],
+        img: np.ndarray,
+        mask: np.ndarray,
+        n_solutions: int,
+        method: Optional[str] = 'numba',
+        extreme_costs_only: Optional[bool] = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Lookup-table based inversion on images using the RMSE as cost
+    function. Only the unmasked pixels are passed to the inversion
+    as a compact (num_pixels, num_bands) array, the results are
+    scattered back into the image geometry afterwards.
+
+    :param lut:
+        LUT with synthetic (i.e., RTM-simulated) spectra in the
+        spectral resolution of the sensor used. The shape of the LUT
+        must equal (num_spectra, num_bands). To invert many images
+        with the same LUT, pass a `PreparedLUT` instead.
+    :param img:
+        image with sensor spectra. The number of spectral bands must
+        match the number  of spectral bands in the LUT. The shape of
+        the img must equal (num_bands, num_rows, num_columns).
+    :param mask:
+        mask of `img.shape[1], img.shape[2]` to skip pixels. If all
+        pixels should be processed set all cells in `mask` to False.
+        Pixels with NaNs in their spectrum are always skipped.
+    :param n_solutions:
+        number of best solutions to return (where cost function is
+        minimal)
+    :param method:
+        'numba' (default) to use `inv_pixels_rmse`, 'gemm' to use
+        `inv_pixels_gemm`, 'int16' to use `inv_pixels_ssd_int16` on
+        quantized spectra or 'kdtree' to use `inv_pixels_kdtree`.
+        Ignored if `lut` is a `PreparedLUT`.
+    :param extreme_costs_only:
+        if True, only the lowest and highest cost function value of
+        every pixel are returned to save memory. False by default.
+    :returns:
+        tuple with two ``np.ndarray`` of shape
+        `(n_solutions, img_rows, img_columns)` where for each pixel
+        the `n_solutions` best solutions are returned as row indices
+        in the `lut` in the first tuple element and the corresponding
+        cost function values in the second (of shape
+        `(2, img_rows, img_columns)` if `extreme_costs_only`). Masked
+        pixels have a LUT index of -1.
+    """
+    if not isinstance(lut, PreparedLUT):
+        lut = PreparedLUT(lut, method)
+    if n_solutions > lut.n_spectra:
+        raise ValueError(
+            'The number of solutions must not be greater than the lookup-table size'
+        )
+    n_bands = img.shape[0]
+    output_shape = (n_solutions, img.shape[1], img.shape[2])
+    # array for storing best matching LUT indices
+    lut_idxs = np.full(output_shape, -1, dtype='int32')
+    # array for storing cost function values
+    n_costs = 2 if extreme_costs_only else n_solutions
+    cost_function_values = np.zeros(
+        (n_costs,) + output_shape[1:], dtype='float32')
+
+    # compact the unmasked pixels into one spectrum per row. Pixels
+    # with NaNs in their spectrum are masked as well
+    valid = np.flatnonzero(
+        ~mask.ravel() & ~np.isnan(img).any(axis=0).ravel())
+    pixels = img.reshape(n_bands, -1)[:, valid].T
+
+    if lut.method == 'int16':
+        pixels = np.ascontiguousarray(quantize_reflectance(pixels))
+        pixel_lut_idxs = np.empty((valid.size, n_solutions), dtype='int32')
+        pixel_ssd = np.empty((valid.size, n_solutions), dtype='int64')
+        inv_pixels_ssd_int16(
+            lut.lut, pixels, n_solutions, pixel_lut_idxs, pixel_ssd)
+        # only the winning distances are converted back to RMSE
+        pixel_cost_function_values = (
+            np.sqrt(pixel_ssd / n_bands) / reflectance_scale
+        ).astype('float32')
+    elif lut.method == 'numba':
+        pixels = np.ascontiguousarray(
+            pixels[:, lut.band_order], dtype=np.float32)
+        pixel_lut_idxs = np.empty((valid.size, n_solutions), dtype='int32')
+        pixel_cost_function_values = np.empty(
+            (valid.size, n_solutions), dtype='float32')
+        inv_pixels_rmse(
+            lut.lut, pixels, n_solutions,
+            pixel_lut_idxs, pixel_cost_function_values)
+        # map the rows of the sorted LUT to the original ones
+        pixel_lut_idxs = lut.row_order[pixel_lut_idxs]
+    elif lut.method == 'gemm':
+        pixels = np.ascontiguousarray(pixels, dtype=np.float32)
+        pixel_lut_idxs, pixel_cost_function_values = inv_pixels_gemm(
+            lut.lut, pixels, n_solutions)
+    else:
+        pixel_lut_idxs, pixel_cost_function_values = inv_pixels_kdtree(
+            lut.tree, pixels, n_solutions, workers=lut.workers)
+
+    # scatter the results back into the image geometry
+    lut_idxs.reshape(n_solutions, -1)[:, valid] = pixel_lut_idxs.T
+    if extreme_costs_only:
+        pixel_cost_function_values = pixel_cost_function_values[:, [0, -1]]
+    cost_function_values.reshape(n_costs, -1)[:, valid] = \
+        pixel_cost_function_values.T
+    return lut_idxs, cost_function_values
+
+def median_of_solutions(
+        values: np.ndarray,
+        lut_idxs: np.ndarray,
+        chunk_rows: Optional[int] = 16
+    ) -> np.ndarray:
+    """
+    Median of a trait (e.g., LAI) over the best solutions of every pixel
+    as returned by `inv_img_compact`. The median is computed for a few
+    image rows at a time so that the trait values of all solutions are
+    never held in memory for the entire image.
+
+    :param values:
+        trait values of the LUT of shape (num_spectra,)
+    :param lut_idxs:
+        row indices in the LUT of the best solutions of shape
+        `(n_solutions, img_rows, img_columns)`. Pixels without solutions
+        have an index of -1.
+    :param chunk_rows:
+        number of image rows processed at once
+    :returns:
+        `float32` array of shape `(img_rows, img_columns)` with the median
+        trait values (NaN for pixels without solutions)
+    """
+    values = np.asarray(values)
+    median = np.empty(lut_idxs.shape[1:], dtype='float32')
+    for row in range(0, lut_idxs.shape[1], chunk_rows):
+        rows = slice(row, row + chunk_rows)
+        median[rows] = np.median(values.take(lut_idxs[:, rows]), axis=0)
+    median[lut_idxs[0] == -1] = np.nan
+    return median
+
 # @njit(cache=True, parallel=True)
 def _retrieve_traits(
         trait_values: np.ndarray,
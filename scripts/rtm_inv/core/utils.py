@@ -1,12 +1,17 @@
 """
 """
 
+import os
 import pandas as pd
 import numpy as np
+import re
 
+from pathlib import Path
 from scipy.stats import poisson
-from typing import Optional
+from typing import List, Optional, Tuple
 
+# month folders start with two digits, an underscore and three letters
+month_folder_pattern = re.compile(r'^\d{2}_[A-Za-z]{3}')
 green_peak_threshold = 547 # nm
 green_region = (500, 600) # nm
 
@@ -276,4 +281,80 @@ def transform_lai(lai: pd.Series | np.ndarray | float, inverse: Optional[bool] =
     # LAI to transformed values
     else:
         return 1 - np.exp(-0.2 * lai)
-    
\ No newline at end of file
+    
+
+def load_lut(lut_file: Path, bands: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the simulated reflectance of the selected bands and the LAI values
+    from a lookup-table.
+
+    The first time a LUT is read, both arrays are stored as float32 `.npy`
+    files next to the LUT. Afterwards, these files are memory-mapped instead
+    of reading the entire DataFrame. Scenes sharing the same LUT therefore
+    also share the memory-mapped pages.
+
+    :param lut_file:
+        path to the lookup-table (parquet or pickled DataFrame). LUTs shared
+        between scenes might be symbolic links to the cached LUT.
+    :param bands:
+        names of the bands (LUT columns) to read
+    :returns:
+        simulated reflectance of shape (num_spectra, num_bands) and LAI
+        values of shape (num_spectra,)
+    """
+    # the cached arrays are stored next to the (resolved) LUT
+    lut_file = Path(lut_file).resolve()
+    fpath_refl = lut_file.with_name(f'{lut_file.stem}_{"-".join(bands)}.npy')
+    fpath_lai = lut_file.with_name(f'{lut_file.stem}_lai.npy')
+    if fpath_refl.exists() and fpath_lai.exists():
+        sim_refl = np.load(fpath_refl, mmap_mode='r')
+        lai = np.load(fpath_lai, mmap_mode='r')
+        return sim_refl, lai
+
+    if lut_file.suffix == '.parquet':
+        lut = pd.read_parquet(lut_file, columns=bands + ['lai'])
+    else:
+        lut = pd.read_pickle(lut_file)
+    sim_refl = np.ascontiguousarray(lut[bands].values, dtype=np.float32)
+    lai = np.ascontiguousarray(lut['lai'].values, dtype=np.float32)
+    # write to a temporary file first so that an interrupted run does not
+    # leave a truncated cache behind
+    for fpath, values in zip([fpath_refl, fpath_lai], [sim_refl, lai]):
+        fpath_tmp = fpath.with_suffix(f'.{os.getpid()}.tmp.npy')
+        np.save(fpath_tmp, values, allow_pickle=False)
+        os.replace(fpath_tmp, fpath)
+    return sim_refl, lai
+
+def init_worker() -> None:
+    """
+    Limit a worker process to a single thread. Use as `initializer` of a
+    process pool whose workers run the inversion in parallel already, so
+    that the parallel Numba kernels and BLAS (NumPy) do not start a thread
+    per core in every worker.
+    """
+    # only needed in the workers of the LAI retrieval
+    import numba
+    from threadpoolctl import threadpool_limits
+    numba.set_num_threads(1)
+    threadpool_limits(limits=1)
+
+def default_max_workers(bytes_per_worker: int) -> int:
+    """
+    Default number of worker processes: one per CPU but not more than fit
+    into the memory currently available (as reported by the Linux kernel,
+    one per CPU on other systems).
+
+    :param bytes_per_worker:
+        peak memory (bytes) a worker needs
+    :returns:
+        number of worker processes (at least one)
+    """
+    n_cpus = os.cpu_count() or 1
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        # the value is given in kB
+        available = int(meminfo['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return n_cpus
+    return max(1, min(n_cpus, available // bytes_per_worker))
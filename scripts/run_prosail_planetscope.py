@@ -22,15 +22,26 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
+import json
+import os
+import re
 import shutil
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from eodal.config import get_settings
 from pathlib import Path
-from typing import Any, Dict
-from xml.dom import minidom
+from typing import Any, Dict, List, Optional
+
+try:
+    from lxml import etree
+except ImportError:
+    # fall back to the (slower) parser of the standard library
+    from xml.etree import ElementTree as etree
 
 from rtm_inv.core.config import RTMConfig
 from rtm_inv.core.lookup_table import generate_lut
+from rtm_inv.core.utils import month_folder_pattern
 
 
 # metadata entries to be extracted from the xml file
@@ -39,9 +50,18 @@ eop_angle_mapping = {
     'ps:azimuthAngle': 'relative_azimuth_angle',
     'opt:illuminationElevationAngle': 'sun_elevation'
 }
+# the metadata files are generated by Planet and have a stable
+# structure, thus the angles are usually found without parsing the xml
+angle_pattern = re.compile(
+    rb'<(' + b'|'.join(re.escape(tag.encode()) for tag in eop_angle_mapping)
+    + rb')\b[^>]*>([^<]+)</\1>')
 
 # configuration of the PROSAIL forward simulations
 platform = 'PlanetSuperDove'
+lut_size = 50000
+# resolution (degrees) the viewing and illumination angles are rounded
+# to. Scenes with the same rounded angles share their LUT
+angle_resolution = 0.5
 # set up the RTM configuration
 rtm_config = RTMConfig(
     traits=['lai'],
@@ -57,6 +77,33 @@ def parse_metadata_xml(in_file: Path) -> Dict[str, Any]:
     Parses the metadata file (*.xml) delivered with the Planet-Scope
     mapper to extract the EPSG code of the scene and the orbit directions
 
+    The angles are searched in the raw file content first. If an angle
+    is not found exactly once (e.g., the namespace prefixes differ),
+    the file is parsed as xml.
+
+    Parameters
+    ----------
+    in_file : Path
+        Path to the metadata file
+    return : Dict[str, Any]
+        Dictionary containing the viewing and illimination angles
+    """
+    matches = {}
+    for match in angle_pattern.finditer(Path(in_file).read_bytes()):
+        matches.setdefault(match.group(1).decode(), []).append(match.group(2))
+    if len(matches) == len(eop_angle_mapping) and \
+            all(len(values) == 1 for values in matches.values()):
+        return {
+            eop_angle_mapping[tag]: float(values[0])
+            for tag, values in matches.items()}
+    return _parse_metadata_xml_tree(in_file)
+
+
+def _parse_metadata_xml_tree(in_file: Path) -> Dict[str, Any]:
+    """
+    Parses the metadata file (*.xml) as xml to extract the viewing
+    and illumination angles (see `parse_metadata_xml`).
+
     Parameters
     ----------
     in_file : Path
@@ -64,71 +111,251 @@ def parse_metadata_xml(in_file: Path) -> Dict[str, Any]:
     return : Dict[str, Any]
         Dictionary containing the viewing and illimination angles
     """
-    # parse the xml file into a minidom object
-    xmldoc = minidom.parse(str(in_file))
+    # parse the xml file (using libxml2 if available) and collect
+    # the namespace prefixes declared in the file
+    namespaces = {}
+    context = etree.iterparse(str(in_file), events=('start-ns', 'end'))
+    for event, item in context:
+        if event == 'start-ns' and item[0]:
+            namespaces.setdefault(item[0], item[1])
     # get the acquisition parameters
-    eop_params = xmldoc.getElementsByTagName(
-        "eop:acquisitionParameters")[0]
-    ps_params = eop_params.getElementsByTagName(
-        "ps:Acquisition")[0]
+    ps_params = context.root.find(
+        './/eop:acquisitionParameters//ps:Acquisition', namespaces)
     # get the angles
     angles = {}
     for eop_angle in eop_angle_mapping.items():
         angles[eop_angle[1]] = float(
-            ps_params.getElementsByTagName(
-                eop_angle[0])[0].firstChild.nodeValue)
+            ps_params.findtext(f'.//{eop_angle[0]}', namespaces=namespaces))
     return angles
 
 
-def run_prosail_planetscope(path: Path):
+def _lut_cache_key(
+        angles: Dict[str, float],
+        platform: str,
+        lut_params: Path,
+        lut_size: int
+) -> str:
+    """
+    Key identifying a LUT by its inputs. Scenes with the same
+    (rounded) viewing and illumination geometry share the same key.
+
+    Parameters
+    ----------
+    angles : Dict[str, float]
+        Viewing and illumination angles of the scene rounded to
+        `angle_resolution`
+    platform : str
+        Name of the platform (sensor) to simulate
+    lut_params : Path
+        Path to the CSV file with the PROSAIL parameters
+        (its modification time is part of the key)
+    lut_size : int
+        Number of spectra in the LUT
+    return : str
+        Hexadecimal key
+    """
+    inputs = dict(angles)
+    inputs.update({
+        'platform': platform,
+        'lut_params_mtime': lut_params.stat().st_mtime,
+        'lut_size': lut_size})
+    return hashlib.blake2b(
+        json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _link_lut(fpath_cache: Path, lut_file: Path) -> None:
+    """
+    Link a scene's LUT file to a LUT in the cache (falls back
+    to copying if symbolic links are not supported).
+
+    Parameters
+    ----------
+    fpath_cache : Path
+        Path to the cached LUT
+    lut_file : Path
+        Path to the LUT of the scene
+    """
+    try:
+        lut_file.symlink_to(os.path.relpath(fpath_cache, lut_file.parent))
+    except OSError:
+        shutil.copy(fpath_cache, lut_file)
+
+
+def _has_lut(scene: Path, lut_dir: Path) -> bool:
+    """
+    Check if a scene has a LUT already. LUTs from older runs are
+    pickled and are used by the LAI retrieval as well.
+
+    Parameters
+    ----------
+    scene : Path
+        Path to the metadata file (*.xml) of the scene
+    lut_dir : Path
+        Directory with the LUTs
+    return : bool
+        True if a parquet or pickled LUT exists
+    """
+    return any(
+        (lut_dir / (scene.stem + suffix)).exists()
+        for suffix in ['.parquet', '.pkl'])
+
+
+def _scene_angles(scene: Path) -> Dict[str, float]:
+    """
+    Viewing and illumination angles of a scene rounded to
+    `angle_resolution`. The LUT is simulated for the rounded
+    angles so that it is the same for all scenes sharing it.
+
+    Parameters
+    ----------
+    scene : Path
+        Path to the metadata file (*.xml) of the scene
+    return : Dict[str, float]
+        Rounded viewing and illumination angles (as expected
+        by `generate_lut`)
+    """
+    angles = parse_metadata_xml(scene)
+    angles['solar_zenith_angle'] = 90 - angles['sun_elevation']
+    del angles['sun_elevation']
+    return {
+        name: round(value / angle_resolution) * angle_resolution
+        for name, value in angles.items()}
+
+
+def _simulate_lut(
+        fpath_cache: Path,
+        angles: Dict[str, float],
+        platform: str,
+        lut_params: Path
+) -> Path:
+    """
+    Run the PROSAIL forward simulation for a viewing and
+    illumination geometry and save the resulting LUT to the cache.
+
+    Parameters
+    ----------
+    fpath_cache : Path
+        Path to the cached LUT
+    angles : Dict[str, float]
+        Rounded viewing and illumination angles
+    platform : str
+        Name of the platform (sensor) to simulate
+    lut_params : Path
+        Path to the CSV file with the PROSAIL parameters
+    return : Path
+        Path to the cached LUT
+    """
+    # run the PROSAIL forward simulation
+    lut = generate_lut(
+        sensor=platform,
+        lut_params=lut_params,
+        remove_invalid_green_peaks=True,
+        sampling_method='frs',
+        lut_size=lut_size,
+        **angles)
+    # drop NaNs in the LUT
+    lut = lut.dropna()
+    # save the LUT as zstd-compressed parquet. Write to a temporary
+    # file first so that an interrupted run leaves no partial LUT
+    fpath_tmp = fpath_cache.with_suffix(f'.{os.getpid()}.tmp')
+    lut.to_parquet(fpath_tmp, compression='zstd', engine='pyarrow')
+    os.replace(fpath_tmp, fpath_cache)
+    return fpath_cache
+
+
+def run_prosail_planetscope(
+        path: Path,
+        max_workers: Optional[int] = None
+) -> None:
     """
     Run PROSAIL forward simulations for each scene in
-    the PlanetScope dataset
+    the PlanetScope dataset. Scenes with the same (rounded)
+    viewing and illumination geometry share their LUT, thus
+    a simulation is run once per geometry. The simulations
+    are run in parallel.
 
     Parameters
     ----------
     path : Path
         Path to the PlanetScope dataset
+    max_workers : Optional[int]
+        Number of worker processes. Defaults to the number
+        of CPUs.
     """
+    # scenes (LUT files) to link per cached LUT to simulate
+    lut_groups: Dict[Path, List[Path]] = {}
+    lut_angles: Dict[Path, Dict[str, float]] = {}
     # loop over the folders. Jump into a folder if it starts
     # with two digits followed by an underscore and three letters
-    for folder in path.iterdir():
-        if folder.name[:2].isdigit() and folder.name[2] == '_':
-            # loop over the scenes
-            metadata_dir = folder / 'metadata'
-            # directory for saving the LUTs to
-            lut_dir = folder / 'lut'
-            lut_dir.mkdir(exist_ok=True)
-            for scene in metadata_dir.glob('*.xml'):
-                # file name of the LUT
-                lut_file = lut_dir / (scene.stem + '.pkl')
-                if lut_file.exists():
-                    continue
-                # read the metadata
-                metadata = metadata_dir / (scene.stem + '.xml')
-                try:
-                    angles = parse_metadata_xml(metadata)
-                except Exception as e:
-                    logger.error(f'Could not parse {metadata}: {e}')
-                    errored_xml_dir = metadata_dir / 'errored_xml'
-                    errored_xml_dir.mkdir(exist_ok=True)
-                    shutil.move(metadata, errored_xml_dir)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and month_folder_pattern.match(entry.name):
+                folder = Path(entry.path)
+                # loop over the scenes
+                metadata_dir = folder / 'metadata'
+                # directory for saving the LUTs to
+                lut_dir = folder / 'lut'
+                lut_dir.mkdir(exist_ok=True)
+                if not metadata_dir.is_dir():
                     continue
-                angles['solar_zenith_angle'] = 90 - angles['sun_elevation']
-                del angles['sun_elevation']
-                # run the PROSAIL forward simulation
-                lut = generate_lut(
-                    sensor=platform,
-                    lut_params=rtm_config.lut_params,
-                    remove_invalid_green_peaks=True,
-                    sampling_method='frs',
-                    lut_size=50000,
-                    **angles)
-                # drop NaNs in the LUT
-                lut = lut.dropna()
-                # save the LUT as pickle
-                lut.to_pickle(lut_file)
-                logger.info(f'Processed {folder.name}: {scene.name}')
+                # scenes with the same geometry share their LUT
+                lut_cache_dir = lut_dir.parent.parent / 'lut_cache'
+                lut_cache_dir.mkdir(exist_ok=True)
+                with os.scandir(metadata_dir) as scene_entries:
+                    for scene_entry in scene_entries:
+                        if not (scene_entry.is_file() and
+                                scene_entry.name.endswith('.xml')):
+                            continue
+                        scene = Path(scene_entry.path)
+                        if _has_lut(scene, lut_dir):
+                            logger.info(f'Skipped {scene.name}')
+                            continue
+                        # read the metadata
+                        try:
+                            angles = _scene_angles(scene)
+                        except Exception as e:
+                            logger.error(f'Could not parse {scene}: {e}')
+                            errored_xml_dir = metadata_dir / 'errored_xml'
+                            errored_xml_dir.mkdir(exist_ok=True)
+                            shutil.move(scene, errored_xml_dir)
+                            continue
+                        lut_key = _lut_cache_key(
+                            angles, platform, rtm_config.lut_params,
+                            lut_size)
+                        fpath_cache = \
+                            lut_cache_dir / f'{platform}_{lut_key}.parquet'
+                        lut_file = lut_dir / (scene.stem + '.parquet')
+                        if fpath_cache.exists():
+                            _link_lut(fpath_cache, lut_file)
+                            logger.info(
+                                f'Reused cached LUT for {folder.name}: '
+                                f'{scene.name}')
+                            continue
+                        lut_groups.setdefault(fpath_cache, []).append(
+                            lut_file)
+                        lut_angles[fpath_cache] = angles
+
+    # run one simulation per geometry in parallel and link the LUT
+    # to the scenes sharing it once it is saved. A simulation takes
+    # long compared to the overhead of submitting a task, thus the
+    # simulations are submitted one by one to balance the load
+    with ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                _simulate_lut,
+                fpath_cache,
+                angles,
+                platform,
+                rtm_config.lut_params)
+            for fpath_cache, angles in lut_angles.items()]
+        for future in as_completed(futures):
+            fpath_cache = future.result()
+            for lut_file in lut_groups[fpath_cache]:
+                _link_lut(fpath_cache, lut_file)
+                logger.info(
+                    f'Processed {lut_file.parent.parent.name}: '
+                    f'{lut_file.stem}')
 
 
 if __name__ == '__main__':
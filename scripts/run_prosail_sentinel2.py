@@ -22,12 +22,18 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+
+from concurrent.futures import ProcessPoolExecutor
 from eodal.config import get_settings
 from eodal.metadata.sentinel2.parsing import parse_MTD_TL
+from itertools import repeat
 from pathlib import Path
+from typing import Optional
 
 from rtm_inv.core.config import RTMConfig
 from rtm_inv.core.lookup_table import generate_lut
+from rtm_inv.core.utils import month_folder_pattern
 
 
 # metadata entries to be extracted from the xml file
@@ -52,54 +58,120 @@ rtm_config = RTMConfig(
 logger = get_settings().logger
 
 
-def run_prosail_sentinel2(path: Path) -> None:
+def _has_lut(scene: Path, lut_dir: Path) -> bool:
+    """
+    Check if a scene has a LUT already. LUTs from older runs are
+    pickled and are used by the LAI retrieval as well.
+
+    Parameters
+    ----------
+    scene : Path
+        Path to the metadata file (MTD_TL.xml) of the scene
+    lut_dir : Path
+        Directory with the LUTs
+    return : bool
+        True if a parquet or pickled LUT exists
+    """
+    return any(
+        (lut_dir / (scene.stem + suffix)).exists()
+        for suffix in ['.parquet', '.pkl'])
+
+
+def _process_scene(
+        scene: Path,
+        lut_dir: Path,
+        lut_params: Path
+) -> str:
+    """
+    Run the PROSAIL forward simulation for a single scene
+    and save the resulting LUT.
+
+    Parameters
+    ----------
+    scene : Path
+        Path to the metadata file (MTD_TL.xml) of the scene
+    lut_dir : Path
+        Directory for saving the LUT to
+    lut_params : Path
+        Path to the CSV file with the PROSAIL parameters
+    return : str
+        Status message
+    """
+    # file name of the LUT
+    lut_file = lut_dir / (scene.stem + '.parquet')
+    if _has_lut(scene, lut_dir):
+        return f'Skipped {scene.name}'
+    # parse the metadata
+    metadata_df = parse_MTD_TL(str(scene))
+    angles = {}
+    for s2_angle in s2_angle_mapping.items():
+        angles[s2_angle[1]] = float(
+            metadata_df[s2_angle[0]])
+    # check the sensor
+    sensor = metadata_df['SCENE_ID'].split('_')[0]
+    platform = s2_platform_mapping[sensor]
+    # run the PROSAIL forward simulation
+    lut = generate_lut(
+        sensor=platform,
+        lut_params=lut_params,
+        remove_invalid_green_peaks=True,
+        sampling_method='frs',
+        lut_size=50000,
+        **angles)
+    # drop NaNs in the LUT
+    lut = lut.dropna()
+    # save the LUT as zstd-compressed parquet
+    lut.to_parquet(lut_file, compression='zstd', engine='pyarrow')
+    return f'Processed {lut_dir.parent.name}: {scene.name}'
+
+
+def run_prosail_sentinel2(
+        path: Path,
+        max_workers: Optional[int] = None
+) -> None:
     """
     Run PROSAIL forward simulations for each scene in
-    the PlanetScope dataset
+    the Sentinel-2 dataset. The scenes are processed
+    in parallel.
 
     Parameters
     ----------
     path : Path
-        Path to the PlanetScope dataset
+        Path to the Sentinel-2 dataset
+    max_workers : Optional[int]
+        Number of worker processes. Defaults to the number
+        of CPUs.
     """
+    scenes, lut_dirs = [], []
     # loop over the folders. Jump into a folder if it starts
     # with two digits followed by an underscore and three letters
-    for folder in path.iterdir():
-        if folder.name[:2].isdigit() and folder.name[2] == '_':
-            # loop over the scenes
-            metadata_dir = folder / 'metadata'
-            # directory for saving the LUTs to
-            lut_dir = folder / 'lut'
-            lut_dir.mkdir(exist_ok=True)
-            for scene in metadata_dir.glob('*.xml'):
-                # file name of the LUT
-                lut_file = lut_dir / (scene.stem + '.pkl')
-                if lut_file.exists():
-                    continue
-                # read the metadata
-                metadata = metadata_dir / (scene.stem + '.xml')
-                # parse the metadata
-                metadata_df = parse_MTD_TL(str(metadata))
-                angles = {}
-                for s2_angle in s2_angle_mapping.items():
-                    angles[s2_angle[1]] = float(
-                        metadata_df[s2_angle[0]])
-                # check the sensor
-                sensor = metadata_df['SCENE_ID'].split('_')[0]
-                platform = s2_platform_mapping[sensor]
-                # run the PROSAIL forward simulation
-                lut = generate_lut(
-                    sensor=platform,
-                    lut_params=rtm_config.lut_params,
-                    remove_invalid_green_peaks=True,
-                    sampling_method='frs',
-                    lut_size=50000,
-                    **angles)
-                # drop NaNs in the LUT
-                lut = lut.dropna()
-                # save the LUT as pickle
-                lut.to_pickle(lut_file)
-                logger.info(f'Processed {folder.name}: {scene.name}')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and month_folder_pattern.match(entry.name):
+                folder = Path(entry.path)
+                # loop over the scenes
+                metadata_dir = folder / 'metadata'
+                # directory for saving the LUTs to
+                lut_dir = folder / 'lut'
+                lut_dir.mkdir(exist_ok=True)
+                for scene in metadata_dir.glob('*.xml'):
+                    # only scenes without LUT are submitted to the workers
+                    if _has_lut(scene, lut_dir):
+                        logger.info(f'Skipped {scene.name}')
+                        continue
+                    scenes.append(scene)
+                    lut_dirs.append(lut_dir)
+
+    # run the simulations scene by scene in parallel
+    with ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count()) as executor:
+        for status in executor.map(
+                _process_scene,
+                scenes,
+                lut_dirs,
+                repeat(rtm_config.lut_params),
+                chunksize=1):
+            logger.info(status)
 
 
 if __name__ == '__main__':